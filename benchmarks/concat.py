@@ -0,0 +1,92 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-04
+
+Function: Benchmarks the assembly of colocalized rows: incremental pd.concat (one per piece) versus streaming chunked writes.
+          Run from the project root: python -m benchmarks.concat
+"""
+
+
+
+import os, time, tempfile
+import numpy as np
+import pandas as pd
+from storage import write_chunks
+
+
+
+ROW_COUNTS = [1000, 2000, 4000, 8000, 16000]
+COLUMNS = ["time", "lat", "lon", "depth", "abundance_prochloro", "sst", "chl", "sla", "NO3", "PO4"]
+
+
+def chunked(frames, chunkRows):
+    """
+    Takes an iterable of dataframes and yields them concatenated in chunks of at least `chunkRows` rows
+    (except for the last chunk), so that many small frames are assembled with a single concat per chunk.
+    """
+    chunk, rowCount = [], 0
+    for df in frames:
+        chunk.append(df)
+        rowCount += len(df)
+        if rowCount >= chunkRows:
+            yield pd.concat(chunk, ignore_index=True)
+            chunk, rowCount = [], 0
+    if len(chunk) > 0: yield pd.concat(chunk, ignore_index=True)
+
+
+def single_row_frames(rowCount):
+    """
+    Yields single-row dataframes, mimicking the output of the original per-row colocalization.
+    """
+    data = np.random.rand(rowCount, len(COLUMNS))
+    for i in range(rowCount):
+        yield pd.DataFrame(data[i:i+1], columns=COLUMNS)
+
+
+def incremental(frames, path):
+    """
+    The original assembly: grows a dataframe with one pd.concat per piece and writes it at the end.
+    """
+    df = pd.DataFrame({})
+    for fo in frames:
+        if len(df) < 1:
+            df = fo
+        else:
+            df = pd.concat([df, fo], ignore_index=True)
+    df.to_csv(path, index=False)
+    return len(df)
+
+
+def streaming(frames, path):
+    """
+    The streaming assembly: one concat per chunk, appended to the output file.
+    """
+    return write_chunks(chunked(frames, 1000), path)
+
+
+def main():
+    print(f"{'rows':>8} {'incremental [s]':>16} {'streaming [s]':>14} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, "out.csv")
+        for rowCount in ROW_COUNTS:
+            elapsed = []
+            for assemble in (incremental, streaming):
+                tic = time.perf_counter()
+                assemble(single_row_frames(rowCount), path)
+                elapsed.append(time.perf_counter() - tic)
+            print(f"{rowCount:>8} {elapsed[0]:>16.3f} {elapsed[1]:>14.3f} {elapsed[0] / elapsed[1]:>8.1f}")
+
+
+
+
+#######################################
+#                                     #
+#                                     #
+#                 main                #
+#                                     #
+#                                     #
+#######################################
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-10-12
+
+Function: Checks that all colocalization modes return the same matches: the per-row SQL queries (`match_rows`),
+          the client-side tiles with both averaging backends (`match_batch`), and the set-based blocks (`match_blocks`),
+          against the SQLite stand-in of benchmarks/pipeline.py. The observations include rows outside the temporal
+          coverage of the tables (matched by [month]) and the tables with a depth dimension.
+          Run from the project root: python -m benchmarks.equivalence --rows 200
+          Exits with a non-zero status if any mode differs from `match_rows`.
+"""
+
+
+
+import os, sys, argparse, tempfile
+import numpy as np
+import pandas as pd
+from settings import DEPTH1
+from registry import environmental_datasets, env_vars
+from colocalize import add_env_columns, add_env_temporal_coverage, match_rows, match_batch, match_blocks
+from benchmarks.mock_cmap import synthetic_env_db
+from benchmarks.pipeline import FakeAPI, GRID
+import colocalize
+
+
+
+def observations(rowCount, seed=0):
+    """
+    Returns `rowCount` synthetic cyano observations scattered over (and slightly beyond) the extent of the synthetic
+    environmental tables. A third of them are a year earlier, outside the temporal coverage of the tables, 
+    so that they are matched by [month].
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(GRID["startDate"])
+    days = rng.uniform(-2, GRID["days"] + 2, rowCount) - 365 * (rng.random(rowCount) < 1 / 3)
+    return pd.DataFrame({
+                         "time": (start + pd.to_timedelta(days, unit="D")).strftime("%Y-%m-%dT%H:%M:%S"),
+                         "lat": rng.uniform(GRID["latRange"][0] - 1, GRID["latRange"][1] + 1, rowCount).round(4),
+                         "lon": rng.uniform(GRID["lonRange"][0] - 1, GRID["lonRange"][1] + 1, rowCount).round(4),
+                         "depth": rng.uniform(DEPTH1, 20, rowCount).round(1)
+                         })
+
+
+def run_modes(api, df, envs):
+    """
+    Colocalizes the observations in every mode and returns a dict mapping each mode to the (rows x env_vars) matches.
+    """
+    results = {}
+    modes = [("rows", match_rows, None), ("batch/grid", match_batch, "grid"), ("batch/mask", match_batch, "mask"), ("blocks", match_blocks, None)]
+    for name, matcher, backend in modes:
+        if backend is not None: colocalize.AVERAGE_BACKEND = backend    # read by `colocalize.box_average`
+        matched = matcher(add_env_columns(df.copy(), envs), api, envs, "equivalence")
+        results[name] = matched[list(env_vars())].to_numpy(dtype=float)
+    return results
+
+
+def compare(results, reference="rows"):
+    """
+    Prints, for each mode and environmental variable, the number of rows that differ from the `reference` mode
+    (a value on one side and NaN on the other, or a relative difference beyond float32 rounding). Returns the total.
+    """
+    expected = results[reference]
+    mismatches = 0
+    for name, values in results.items():
+        if name == reference: continue
+        differ = ~np.isclose(values, expected, rtol=1e-6, atol=0, equal_nan=True)
+        mismatches += int(differ.sum())
+        for j, v in enumerate(env_vars()):
+            if differ[:, j].any(): print(f"{name:>12} {v:>20}: {differ[:, j].sum()} rows differ from {reference}")
+        print(f"{name:>12}: {int(differ.sum())} mismatches, {int(np.isnan(values).sum())} unmatched values")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that all colocalization modes return the same matches.")
+    parser.add_argument("--rows", type=int, default=200, help="number of synthetic observations.")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic observations.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workDir:
+        os.chdir(workDir)
+        dbPath = synthetic_env_db(os.path.join(workDir, "cmap.sqlite"), **GRID)
+        api = FakeAPI(dbPath)
+        envs = add_env_temporal_coverage(api, environmental_datasets())
+        df = observations(args.rows, args.seed)
+        mismatches = compare(run_modes(api, df, envs))
+    print("All modes match." if mismatches == 0 else f"{mismatches} mismatches.")
+    sys.exit(1 if mismatches > 0 else 0)
+
+
+
+
+#######################################
+#                                     #
+#                                     #
+#                 main                #
+#                                     #
+#                                     #
+#######################################
+
+if __name__ == "__main__":
+    main()
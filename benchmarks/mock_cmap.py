@@ -0,0 +1,144 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-07
+
+Function: A local stand-in for the CMAP query endpoint, backed by a SQLite database of synthetic environmental tables.
+          Queries are held to the T-SQL dialect of the CMAP server (see `tsql_query`) and to a bounded url length.
+          Run from the project root: python -m benchmarks.mock_cmap --port 8080 --latency 0.05 --failure-rate 0.1
+          and point `API_BASE_URL` (settings.py) to http://127.0.0.1:8080
+"""
+
+
+
+import re, sys, time, random, sqlite3, argparse, threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+from registry import environmental_datasets
+
+
+
+URL_LIMIT = 8192    # maximum length [characters] of a request url (path and query string) accepted by the stand-in.
+
+
+def tsql_query(query):
+    """
+    Checks that a query is also valid on the SQL Server behind CMAP, for the constructs where SQLite is more lenient,
+    and returns it in a form SQLite executes (`SELECT TOP n ...` becomes `SELECT ... LIMIT n`).
+    Raises a ValueError for a `LIMIT` clause, and for a VALUES table constructor outside of a derived table
+    (`FROM (VALUES ...)`, `JOIN (VALUES ...)`) or an INSERT statement, e.g. as the body of a common table expression.
+    """
+    if re.search(r"\bLIMIT\b", query, re.IGNORECASE): raise ValueError("LIMIT is not supported by T-SQL (use TOP).")
+    for m in re.finditer(r"\bVALUES\b", query, re.IGNORECASE):
+        before = query[:m.start()]
+        if not re.search(r"\b(FROM|JOIN)\s*\(\s*$", before, re.IGNORECASE) and not re.search(r"\bINSERT\b", before, re.IGNORECASE):
+            raise ValueError("Incorrect syntax near the keyword 'VALUES'.")
+    top = re.match(r"^\s*SELECT\s+TOP\s+(\d+)\s+(.*)$", query, re.IGNORECASE | re.DOTALL)
+    if top: query = f"SELECT {top.group(2)} LIMIT {top.group(1)}"
+    return query
+
+
+def synthetic_env_db(path, startDate="2016-01-01", days=30, latRange=(20, 30), lonRange=(-160, -150), resolution=0.25, depths=(0, 5, 10, 20), seed=0):
+    """
+    Creates a SQLite database at `path` holding a synthetic gridded table for each of the environmental datasets.
+    Times are stored as 'YYYY-MM-DD HH:MM:SS' strings so that they compare correctly with the query bounds, and the
+    non-climatology tables also hold a month column (used by the climatology fallback of the colocalization).
+    """
+    rng = np.random.default_rng(seed)
+    lats = np.arange(latRange[0], latRange[1], resolution) + resolution / 2
+    lons = np.arange(lonRange[0], lonRange[1], resolution) + resolution / 2
+    times = pd.date_range(startDate, periods=days, freq="D").strftime("%Y-%m-%d %H:%M:%S")
+    con = sqlite3.connect(path)
+    for table, env in environmental_datasets().items():
+        axes = {"month": np.arange(1, 13)} if env["isClimatology"] else {"time": np.asarray(times)}
+        axes.update({"lat": lats, "lon": lons})
+        if env["hasDepth"]: axes["depth"] = np.asarray(depths, dtype=float)
+        grid = np.meshgrid(*axes.values(), indexing="ij")
+        df = pd.DataFrame({col: g.ravel() for col, g in zip(axes, grid)})
+        if not env["isClimatology"]: df.insert(1, "month", pd.to_datetime(df["time"]).dt.month)
+        for v in env["variables"]:
+            df[v] = rng.normal(1, 0.1, len(df))
+            df.loc[rng.random(len(df)) < 0.05, v] = np.nan
+        df.to_sql(table, con, index=False, if_exists="replace")
+        indexCols = ", ".join(f"[{col}]" for col in axes)
+        con.execute(f"CREATE INDEX IF NOT EXISTS idx_{table} ON {table} ({indexCols})")
+    con.commit()
+    con.close()
+    return path
+
+
+def make_handler(dbPath, latency, failureRate):
+    """
+    Returns a request handler class that answers `/api/data/query` requests with csv bodies,
+    after an artificial `latency` [s], and fails a `failureRate` fraction of requests with HTTP 503.
+    """
+    local = threading.local()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            return
+
+        def reply(self, status, body):
+            body = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "text/csv")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/api/data/query": return self.reply(404, "not found")
+            if len(self.path) > URL_LIMIT: return self.reply(414, "URI Too Long")
+            if not self.headers.get("Authorization", "").startswith("Api-Key "): return self.reply(401, "Unauthorized")
+            time.sleep(latency)
+            if random.random() < failureRate: return self.reply(503, "Service Unavailable")
+            if not hasattr(local, "con"): local.con = sqlite3.connect(dbPath)
+            try:
+                df = pd.read_sql(tsql_query(parse_qs(url.query)["query"][0]), local.con)
+            except Exception as e:
+                return self.reply(400, str(e))
+            self.reply(200, df.to_csv(index=False))
+
+    return Handler
+
+
+def serve(dbPath, port=8080, latency=0, failureRate=0):
+    """
+    Starts the stand-in server in a background thread and returns it (call `shutdown()` to stop).
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(dbPath, latency, failureRate))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the CMAP query endpoint.")
+    parser.add_argument("--db", default="mock_cmap.sqlite", help="path to the SQLite database (created if missing).")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="artificial latency per request [s].")
+    parser.add_argument("--failure-rate", type=float, default=0, help="fraction of requests failing with HTTP 503.")
+    args = parser.parse_args()
+    synthetic_env_db(args.db)
+    server = serve(args.db, args.port, args.latency, args.failure_rate)
+    print(f"Serving {args.db} at http://127.0.0.1:{args.port}", file=sys.stderr)
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+
+
+#######################################
+#                                     #
+#                                     #
+#                 main                #
+#                                     #
+#                                     #
+#######################################
+
+if __name__ == "__main__":
+    main()
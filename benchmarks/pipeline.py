@@ -0,0 +1,210 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-30
+
+Function: Benchmarks the throughput of the collect, colocalize, and compile stages offline, against a fake `pycmap.API`
+          serving synthetic gridded environmental tables and synthetic cyano observations from a SQLite database.
+          Run from the project root: python -m benchmarks.pipeline --scenarios 1k 100k --latency 0.01 --days 30 --resolution 0.25
+          Each stage runs in a fresh process, so that its peak resident memory is measured on its own (along with that
+          of the largest worker process it spawned, e.g. the compile workers).
+"""
+
+
+
+import os, sys, time, json, sqlite3, argparse, tempfile, resource, threading
+import concurrent.futures
+import multiprocessing
+from urllib.parse import urlencode
+import numpy as np
+import pandas as pd
+from settings import DATA_DIR, COLOCALIZED_DIR, COMPILED_DIR, DEPTH1, DEPTH2, COMPILE_WORKERS, MAX_WORKERS
+from common import makedir
+from registry import cyano_datasets, environmental_datasets
+from storage import data_path, data_files, read_data, write_data, write_chunks
+from collect import download
+from colocalize import cyano_files, add_env_columns, add_env_temporal_coverage, select_matcher
+from compiler import check_schemas, unify_all, compiled_schema
+from benchmarks.mock_cmap import URL_LIMIT, synthetic_env_db, tsql_query
+
+
+
+SCENARIOS = {"1k": 1_000, "100k": 100_000, "1M": 1_000_000}
+STAGES = ["collect", "colocalize", "compile"]
+GRID = {"startDate": "2016-01-01", "days": 30, "latRange": (20, 30), "lonRange": (-160, -150), "resolution": 0.25}    # default extent and resolution of the synthetic tables.
+
+
+class FakeAPI:
+    """
+    A stand-in for `pycmap.API` answering SQL queries from a SQLite database after an artificial `latency` [s].
+    Like `pycmap`, it returns times formatted as '%Y-%m-%dT%H:%M:%S' and an empty dataframe on errors, which include
+    queries that are not valid T-SQL (see `mock_cmap.tsql_query`) or whose url would exceed `mock_cmap.URL_LIMIT`.
+    """
+    def __init__(self, dbPath, latency=0):
+        self.dbPath = dbPath
+        self.latency = latency
+        self.queryCount = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, "con"): self.local.con = sqlite3.connect(self.dbPath)
+        return self.local.con
+
+    def query(self, query):
+        with self.lock: self.queryCount += 1
+        if self.latency > 0: time.sleep(self.latency)
+        try:
+            if len(urlencode({"query": query})) > URL_LIMIT: raise ValueError("URI Too Long")
+            df = pd.read_sql(tsql_query(query), self.connection())
+        except Exception as e:
+            print(f"Query failed:\n{query}\n{e}", file=sys.stderr)
+            return pd.DataFrame({})
+        if "time" in df.columns: df["time"] = pd.to_datetime(df["time"]).dt.strftime("%Y-%m-%dT%H:%M:%S")
+        return df
+
+    def columns(self, table):
+        return [row[1] for row in self.connection().execute(f"PRAGMA table_info({table})")]
+
+    def has_field(self, table, field):
+        return field in self.columns(table)
+
+
+def synthetic_cyano_table(dbPath, dataset, rowCount, grid=GRID, seed=0):
+    """
+    Adds a synthetic table of cyano observations (`dataset` is an element of `cyano_datasets()`) with `rowCount` rows,
+    scattered over the extent of the synthetic environmental tables (`grid`), to the SQLite database at `dbPath`.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(grid["startDate"])
+    df = pd.DataFrame({
+                       "time": (start + pd.to_timedelta(rng.uniform(0, grid["days"], rowCount), unit="D")).strftime("%Y-%m-%d %H:%M:%S"),
+                       "lat": rng.uniform(*grid["latRange"], rowCount).round(4),
+                       "lon": rng.uniform(*grid["lonRange"], rowCount).round(4),
+                       "depth": rng.uniform(DEPTH1, DEPTH2, rowCount).round(1)
+                       })
+    for field in dataset[1]:
+        if field == "cruise":
+            df[field] = rng.choice(["KM1502", "KOK1606", "TN292"], rowCount)
+        else:
+            df[field] = rng.lognormal(10, 1, rowCount)
+            df.loc[rng.random(rowCount) < 0.05, field] = np.nan
+    con = sqlite3.connect(dbPath)
+    df.to_sql(dataset[0], con, index=False, if_exists="replace")
+    con.commit()
+    con.close()
+    return dbPath
+
+
+def collect_stage(api):
+    """
+    Downloads the synthetic cyano table (see collect.py) and returns the number of rows retrieved.
+    """
+    dataset = cyano_datasets()[0]
+    makedir(DATA_DIR)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as queryExecutor:
+        download(api, dataset, DEPTH1, DEPTH2, queryExecutor)
+    return len(read_data(data_path(DATA_DIR, dataset[0]), columns=["lat"]))
+
+
+def colocalize_stage(api):
+    """
+    Colocalizes the downloaded cyano files with all environmental datasets, in the mode selected in settings.py 
+    (see `colocalize.select_matcher`), and returns the number of rows.
+    """
+    makedir(COLOCALIZED_DIR)
+    envs = add_env_temporal_coverage(api, environmental_datasets())
+    match = select_matcher(api)
+    rowCount = 0
+    for cyanoFile in cyano_files(DATA_DIR):
+        df = add_env_columns(read_data(cyanoFile), envs)
+        write_data(match(df, api, envs, cyanoFile), data_path(COLOCALIZED_DIR, os.path.splitext(os.path.basename(cyanoFile))[0]))
+        rowCount += len(df)
+    return rowCount
+
+
+def compile_stage(api):
+    """
+    Unifies and concatenates the colocalized files (see compiler.py) and returns the number of rows compiled.
+    """
+    cyanoFiles = data_files(COLOCALIZED_DIR)
+    check_schemas(cyanoFiles)
+    makedir(COMPILED_DIR)
+    return write_chunks(unify_all(cyanoFiles, COMPILE_WORKERS or os.cpu_count()), data_path(COMPILED_DIR, "compiled"), compiled_schema())
+
+
+def run_stage(stage, workDir, dbPath, latency):
+    """
+    Runs a stage in `workDir` (where the relative data directories are resolved) and returns its measurements.
+    Meant to be executed in a fresh process: the peak resident memory is that of the process, and the worker peak is
+    that of the largest (terminated) process it spawned.
+    """
+    os.chdir(workDir)
+    api = FakeAPI(dbPath, latency)
+    stageFunc = {"collect": collect_stage, "colocalize": colocalize_stage, "compile": compile_stage}[stage]
+    tic = time.perf_counter()
+    rowCount = stageFunc(api)
+    elapsed = time.perf_counter() - tic
+    return {
+            "stage": stage,
+            "rows": rowCount,
+            "seconds": elapsed,
+            "rowsPerSecond": rowCount / elapsed if elapsed > 0 else None,
+            "queries": api.queryCount,
+            "peakRSS": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "peakWorkerRSS": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            }
+
+
+def run_scenario(rowCount, latency, workDir, grid=GRID):
+    """
+    Builds the synthetic databases for a scenario of `rowCount` cyano observations (environmental tables over `grid`)
+    and runs the stages one after the other.
+    """
+    dbPath = os.path.join(workDir, "cmap.sqlite")
+    synthetic_env_db(dbPath, **grid)
+    synthetic_cyano_table(dbPath, cyano_datasets()[0], rowCount, grid)
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for stage in STAGES:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(run_stage, stage, workDir, dbPath, latency).result())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline stages against a fake CMAP API.")
+    parser.add_argument("--scenarios", nargs="+", default=["1k", "100k"], choices=list(SCENARIOS), help="number of cyano observations.")
+    parser.add_argument("--latency", type=float, default=0, help="artificial latency per query [s].")
+    parser.add_argument("--days", type=int, default=GRID["days"], help="number of daily time steps of the synthetic environmental tables.")
+    parser.add_argument("--resolution", type=float, default=GRID["resolution"], help="lat/lon grid spacing of the synthetic environmental tables [deg].")
+    parser.add_argument("--lat-range", type=float, nargs=2, default=GRID["latRange"], help="latitude extent of the synthetic tables [deg].")
+    parser.add_argument("--lon-range", type=float, nargs=2, default=GRID["lonRange"], help="longitude extent of the synthetic tables [deg].")
+    parser.add_argument("--json", help="path to a json file where the results are saved.")
+    args = parser.parse_args()
+    grid = dict(GRID, days=args.days, resolution=args.resolution, latRange=tuple(args.lat_range), lonRange=tuple(args.lon_range))
+
+    results = []
+    print(f"{'scenario':>8} {'stage':>10} {'rows':>9} {'time [s]':>9} {'rows/s':>10} {'queries':>8} {'peak RSS [MB]':>14} {'worker RSS [MB]':>16}")
+    for scenario in args.scenarios:
+        with tempfile.TemporaryDirectory() as workDir:
+            for r in run_scenario(SCENARIOS[scenario], args.latency, workDir, grid):
+                r["scenario"] = scenario
+                results.append(r)
+                print(f"{scenario:>8} {r['stage']:>10} {r['rows']:>9} {r['seconds']:>9.2f} {r['rowsPerSecond']:>10.0f} {r['queries']:>8} {r['peakRSS'] / 1024**2:>14.0f} {r['peakWorkerRSS'] / 1024**2:>16.0f}")
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=2)
+
+
+
+
+#######################################
+#                                     #
+#                                     #
+#                 main                #
+#                                     #
+#                                     #
+#######################################
+
+if __name__ == "__main__":
+    main()
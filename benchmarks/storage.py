@@ -0,0 +1,87 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-14
+
+Function: Benchmarks the read/write time and the file size of the compiled dataset in each storage format.
+          Run from the project root: python -m benchmarks.storage [--rows 1000000]
+          The compiled dataset in "COMPILED_DIR" is used if present, otherwise a synthetic one is generated.
+"""
+
+
+
+import os, time, argparse, tempfile
+import numpy as np
+import pandas as pd
+from settings import PROC, SYNC, PICO, COMPILED_DIR, STORAGE_FORMAT
+from registry import env_vars, cyano_datasets
+from storage import EXTENSIONS, data_path, read_data, write_data, compact
+
+
+
+def synthetic_compiled(rowCount, seed=0):
+    """
+    Returns a synthetic dataframe with the columns and (compact) types of the compiled dataset.
+    """
+    rng = np.random.default_rng(seed)
+    tables = [d.table for d in cyano_datasets()]
+    df = pd.DataFrame({
+                       "time": pd.Series(pd.Timestamp("2010-01-01") + pd.to_timedelta(rng.uniform(0, 3650, rowCount), unit="D")).dt.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "lat": rng.uniform(-60, 60, rowCount),
+                       "lon": rng.uniform(-180, 180, rowCount),
+                       "depth": rng.uniform(0, 5, rowCount),
+                       "table": rng.choice(tables, rowCount),
+                       "cruise": rng.choice(["KM1502", "KOK1606", "TN292", None], rowCount)
+                       })
+    for col in [PROC, SYNC, PICO] + list(env_vars()):
+        df[col] = rng.lognormal(0, 1, rowCount)
+        df.loc[rng.random(rowCount) < 0.1, col] = np.nan
+    return compact(df)
+
+
+def timed(func, *args, **kwargs):
+    """
+    Returns the result of a function call along with its elapsed time [s].
+    """
+    tic = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the storage formats on the compiled dataset.")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="number of rows of the synthetic dataset.")
+    args = parser.parse_args()
+    compiledFile = data_path(COMPILED_DIR, "compiled", STORAGE_FORMAT)
+    if os.path.isfile(compiledFile):
+        df = read_data(compiledFile)
+        print(f"Compiled dataset: {compiledFile} ({len(df)} rows)")
+    else:
+        df = synthetic_compiled(args.rows)
+        print(f"Synthetic compiled dataset ({len(df)} rows)")
+
+    projection = ["lat", "lon", PROC]
+    print(f"{'format':>8} {'write [s]':>10} {'read [s]':>10} {'read 3 cols [s]':>16} {'read lat>=0 [s]':>16} {'size [MB]':>10}")
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for fmt in EXTENSIONS:
+            path = data_path(f"{tmpDir}/", "compiled", fmt)
+            _, writeTime = timed(write_data, df, path)
+            _, readTime = timed(read_data, path)
+            _, projectedTime = timed(read_data, path, columns=projection)
+            _, filteredTime = timed(read_data, path, filters=[("lat", ">=", 0)])
+            size = os.path.getsize(path) / 1024**2
+            print(f"{fmt:>8} {writeTime:>10.2f} {readTime:>10.2f} {projectedTime:>16.2f} {filteredTime:>16.2f} {size:>10.1f}")
+
+
+
+
+#######################################
+#                                     #
+#                                     #
+#                 main                #
+#                                     #
+#                                     #
+#######################################
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-02
+
+Function: A persistent on-disk cache of environmental data retrieved from CMAP, organized in space-time cells.
+"""
+
+
+
+import os, glob
+from settings import CACHE_DIR, CACHE_MAX_BYTES
+from common import makedir
+import pandas as pd
+
+
+
+def cell_name(cell):
+    """
+    Returns a file-name friendly label for a cache cell.
+    A cell is a tuple of (byMonth, timeBucket, latTile, lonTile, depthBand) where `timeBucket` is either a month
+    number (if byMonth is True) or the index of a `TILE_SIZE[0]`-day period since epoch. `depthBand` is None for
+    datasets without a depth dimension.
+    """
+    byMonth, timeBucket, latTile, lonTile, depthBand = cell
+    timeLabel = f"m{timeBucket}" if byMonth else f"t{timeBucket}"
+    depthLabel = "x" if depthBand is None else depthBand
+    return f"{timeLabel}_{latTile}_{lonTile}_{depthLabel}"
+
+
+def cell_path(table, variable, cell, version):
+    """
+    Returns the path to the parquet file holding a single variable of a table within a cache cell.
+    The `version` of the cell (see `colocalize.cell_version`) is part of the file name, so that the cells of a growing 
+    table are fetched again once the table has new records in them.
+    """
+    return f"{CACHE_DIR}{table}/{variable}/{cell_name(cell)}_{version}.parquet"
+
+
+def cache_get(table, variables, coords, cell, version):
+    """
+    Returns a dataframe with the `coords` and `variables` columns of a table within a cache cell.
+    Returns None if any of the variables is missing from the cache, or if the cached variables were
+    not retrieved together (different coordinates). A file evicted by another process meanwhile is a miss.
+    """
+    paths = [cell_path(table, v, cell, version) for v in variables]
+    if not all(os.path.isfile(p) for p in paths): return None
+    try:
+        frames = [pd.read_parquet(p) for p in paths]
+        for p in paths: os.utime(p)
+    except FileNotFoundError:
+        return None
+    for frame in frames[1:]:
+        if not frame[coords].equals(frames[0][coords]): return None
+    df = frames[0][coords].copy()
+    for v, frame in zip(variables, frames): df[v] = frame[v]
+    return df
+
+
+def cache_put(table, variables, coords, cell, version, df):
+    """
+    Stores the `variables` of a table within a cache cell, one parquet file per variable.
+    Dataframes missing any of the expected columns (e.g. failed queries) are not stored.
+    Files are replaced atomically, as several colocalization shards may share the cache.
+    """
+    if not set(coords + variables).issubset(df.columns): return
+    for v in variables:
+        path = cell_path(table, v, cell, version)
+        makedir(os.path.dirname(path))
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        df[coords + [v]].to_parquet(tmpPath, index=False)
+        os.replace(tmpPath, path)
+    return
+
+
+def evict(maxBytes=CACHE_MAX_BYTES):
+    """
+    Removes the least recently used cache files until the total size of the cache is below `maxBytes`.
+    Files removed meanwhile by another process (e.g. a concurrent shard) are skipped.
+    """
+    files = []
+    for f in glob.glob(f"{CACHE_DIR}**/*.parquet", recursive=True):
+        try:
+            files.append((os.path.getmtime(f), os.path.getsize(f), f))
+        except FileNotFoundError:
+            continue
+    totalBytes = sum(size for _, size, _ in files)
+    for _, size, f in sorted(files):
+        if totalBytes <= maxBytes: break
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+        totalBytes -= size
+    return
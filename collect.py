@@ -8,40 +8,143 @@ Function: Retrieve Cyanobacteria measurements in CMAP and store them on local di
 
 
 
-import pycmap
-from settings import DEPTH1, DEPTH2, DATA_DIR
+import os, time, math
+import concurrent.futures
+from collections import deque
+from settings import DEPTH1, DEPTH2, DATA_DIR, MAX_WORKERS, MAX_RETRIES, COLLECT_CHUNK_ROWS, INCREMENTAL, METADATA_TTL
 from config.config import API_KEY
-from common import makedir, cyano_datasets
+from common import halt, makedir, backoff
+from registry import cyano_datasets
+from manifest import load_manifest, save_manifest, fingerprint
+from storage import data_path, write_chunks, compact, arrow_schema
+from metrics import count, timed_query, save_metrics
+from metadata import table_metadata
+import pandas as pd
 
 
 def retrieve(api, dataset, depth1, depth2):
+    """
+    Returns the list of queries retrieving a dataset in chunks of about `COLLECT_CHUNK_ROWS` rows, the retrieved columns,
+    and a signature of the dataset (fields, depth filter, and time extent and row count of the table; None if unknown).
+    Large tables are split into consecutive time ranges (plus a chunk for rows without time).
+    The extent and row count are read from the table metadata (see metadata.py) rather than scanned on every run; they
+    cover the whole table, so the depth filter may leave fewer rows per chunk than `COLLECT_CHUNK_ROWS`.
+    """
     table, fields = dataset[0], ", ".join(dataset[1])
-    hasDepth = api.has_field(table, "depth")
+    metadata = table_metadata(api, [table])[table]
+    hasDepth = metadata is not None and "depth" in metadata["columns"]
     if hasDepth: 
+        columns = ["time", "lat", "lon", "depth"] + list(dataset.fields)
         fields = f" [time], lat, lon, depth, {fields} "
         whereClause = f" WHERE depth BETWEEN {depth1} AND {depth2} "
     else:        
+        columns = ["time", "lat", "lon"] + list(dataset.fields)
         fields = f" [time], lat, lon, {fields} "
         whereClause = ""
     query = f"SELECT {fields} FROM {table} {whereClause}"
-    return api.query(query)
+    if metadata is None or metadata["startTime"] is None or metadata["rowCount"] is None: return [query], columns, None
+    extent = {k: metadata[k] for k in ["startTime", "endTime", "rowCount"]}
+    signature = fingerprint({"fields": dataset[1], "depth": [depth1, depth2], "extent": extent})
+    chunkCount = math.ceil(extent["rowCount"] / COLLECT_CHUNK_ROWS)
+    if chunkCount < 2: return [query], columns, signature
+    startTime = pd.Timestamp(extent["startTime"]).tz_localize(None).floor("s")
+    endTime = pd.Timestamp(extent["endTime"]).tz_localize(None).ceil("s")
+    bounds = pd.date_range(startTime, endTime, periods=chunkCount+1).strftime("%Y-%m-%d %H:%M:%S")
+    conjunction = " AND " if hasDepth else " WHERE "
+    queries = []
+    for i in range(chunkCount):
+        upper = "<=" if i == chunkCount-1 else "<"
+        queries.append(query + conjunction + f"[time] >= '{bounds[i]}' AND [time] {upper} '{bounds[i+1]}' ")
+    queries.append(query + conjunction + "[time] IS NULL ")
+    return queries, columns, signature
+
+
+def fetch_chunk(api, table, query, columns):
+    """
+    Submits a single chunk query of `table` and returns the retrieved dataframe (with compact dtypes, see `storage.compact`).
+    A failed chunk (exception or unexpected response) is retried on its own with jittered exponential backoff.
+    A response without any column is a failure too: a successful query returns a header even if no row matches.
+    """
+    error = ""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            df = timed_query("collect", table, api.query, query)
+            if set(columns).issubset(df.columns): return compact(df[columns].copy())
+            error = f"unexpected columns {list(df.columns)}" if len(df.columns) > 0 else "empty response"
+        except Exception as e:
+            error = repr(e)
+        if attempt < MAX_RETRIES: 
+            count("collect", table, "retries")
+            time.sleep(backoff(attempt))
+    halt(f"Chunk failed after {MAX_RETRIES + 1} attempts ({error}):\n{query}")
+
+
+def raw_schema(columns):
+    """
+    Returns the arrow schema of a retrieved dataset: time as timestamps, cruise as a categorical, and all other columns as floats.
+    """
+    return arrow_schema(columns)
+
+
+def download(api, dataset, depth1, depth2, queryExecutor, previousSignature=None):
+    """
+    Downloads a dataset chunk by chunk and streams the chunks to disk. The chunk queries are submitted to the 
+    `queryExecutor` pool, with at most `MAX_WORKERS` chunks of the dataset pending at any time.
+    The download is skipped if the dataset's signature equals `previousSignature` and the file exists.
+    The file is only replaced once every chunk has been retrieved (see `fetch_chunk`), and the dataset's 
+    signature is returned then.
+    """
+    def chunks():
+        pending = deque()
+        for query in queries:
+            pending.append(queryExecutor.submit(fetch_chunk, api, dataset[0], query, columns))
+            if len(pending) >= MAX_WORKERS: yield pending.popleft().result()
+        while len(pending) > 0: yield pending.popleft().result()
+
+    queries, columns, signature = retrieve(api, dataset, depth1, depth2)
+    path = data_path(DATA_DIR, dataset[0])
+    if signature is not None and signature == previousSignature and os.path.isfile(path):
+        print(f"Skipping {dataset[0]} (unchanged)")
+        return signature
+    print(f"Downloading {dataset[0]} ({len(queries)} chunk(s)) ...")
+    root, ext = os.path.splitext(path)
+    tmpPath = f"{root}.{os.getpid()}.tmp{ext}"
+    try:
+        rowCount = write_chunks((df for df in chunks() if len(df) > 0), tmpPath, raw_schema(columns))
+    except BaseException:
+        if os.path.isfile(tmpPath): os.remove(tmpPath)
+        raise
+    os.replace(tmpPath, path)
+    count("collect", dataset[0], "rows", rowCount)
+    print(f"Downloaded {dataset[0]} ({rowCount} rows)")
+    return signature
 
 
 
 def main():
     """
     Iterates through the list of datasets containing measurements of cyanobacteria.
-    The measurements are retrieved and stored in individual csv files on local disk.
+    The measurements are retrieved concurrently (in chunks for large tables) and stored in individual files 
+    (see `STORAGE_FORMAT`) on local disk.
+    Unchanged datasets are not downloaded again (see `INCREMENTAL`). As the cyano tables may keep growing, their metadata
+    (time extent and row count, which make up their signatures) is then refreshed whatever its age (see `METADATA_TTL`).
     """
+    import pycmap
     api = pycmap.API(token=API_KEY)
     makedir(DATA_DIR)
     cyanos = cyano_datasets()
-    for dataset in cyanos:
-        print("\n********************************")
-        print("Downloading ", dataset, " ...")
-        print("********************************\n")
-        data = retrieve(api, dataset, DEPTH1, DEPTH2)
-        data.to_csv(f"{DATA_DIR}{dataset[0]}.csv", index=False)
+    table_metadata(api, [dataset.table for dataset in cyanos], ttl=0 if INCREMENTAL else METADATA_TTL)
+    manifest = load_manifest()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as queryExecutor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as tableExecutor:
+            futureObjs = []
+            for dataset in cyanos:
+                previousSignature = manifest["collect"].get(dataset[0]) if INCREMENTAL else None
+                futureObjs.append(tableExecutor.submit(download, api, dataset, DEPTH1, DEPTH2, queryExecutor, previousSignature))
+            for dataset, fo in zip(cyanos, futureObjs): 
+                manifest["collect"][dataset[0]] = fo.result()
+                save_manifest(manifest)
+    save_metrics("collect")
 
 
 
@@ -8,138 +8,786 @@ Function: Colocalize cyanobacteria observations with a given list of environment
 
 
 
-import os, glob
+import os, sys, glob, time, zlib, shutil, itertools, argparse, subprocess
 import concurrent.futures
-import pycmap
+from urllib.parse import urlencode
 from config.config import API_KEY
-from settings import DATA_DIR, COLOCALIZED_DIR
-from common import halt, makedir, environmental_datasets
+from settings import DATA_DIR, COLOCALIZED_DIR, BATCH_COLOCALIZE, ASYNC_COLOCALIZE, MAX_WORKERS, MAX_RETRIES, TILE_SIZE, MAX_MASK_SIZE, CHUNK_ROWS, OFFLINE, INCREMENTAL, AVERAGE_BACKEND, SET_BASED_COLOCALIZE, BLOCK_ROWS, MAX_QUERY_LENGTH, SHARDS_DIR, SHARD_ROWS
+from common import halt, makedir, backoff
+from registry import environmental_datasets
+from cache import cell_name, cache_get, cache_put, evict
+from engine import run_queries
+from journal import journal_path, open_journal, completed, record, report, close_journal
+from storage import data_files, data_path, read_data, write_data, compact
+from manifest import load_manifest, save_manifest, file_hash, env_fingerprints
+from gridindex import grid_average
+from metrics import count, timed, timed_query, progress, save_metrics, profiled
+from metadata import table_metadata
+import numpy as np
 import pandas as pd
 import datetime
-from dateutil.parser import parse
 
 
 
-def cyano_csv_files(cyanoDir):
+def cyano_files(cyanoDir):
     """
-    Returns a list of path to csv files that hold observations of cyanobacteria.
+    Returns a list of path to files that hold observations of cyanobacteria.
     """
-    return glob.glob(f"{cyanoDir}*.csv")
+    return data_files(cyanoDir)
 
 
 def add_env_columns(df, envs):
     """
-    Adds new columns to the dataframe form each environmental variable.
+    Adds new columns to the dataframe form each environmental variable, and casts all columns to their compact dtypes 
+    (see `storage.compact`).
     """
     for env in envs.values():
         for v in env.get("variables"):
-            if v not in df.columns: df[v] = None
-    return df
+            if v not in df.columns: df[v] = np.nan
+    return compact(df)
+
+
+def set_values(df, rows, column, values):
+    """
+    Assigns `values` (a scalar, or an array aligned with `rows`) to a column of the dataframe at the given rows, 
+    cast to the column's dtype (None becomes NaN).
+    """
+    values = np.asarray(values, dtype=df[column].dtype)
+    df.loc[rows, column] = values if values.ndim > 0 else values[()]
+    return
+
+
+def refresh_env_columns(df, envs, tables, previousVariables):
+    """
+    Prepares a previously colocalized dataframe for an incremental update: drops the columns of the `previousVariables`
+    that are no longer in `envs`, clears the variables of the `tables` to be matched again, and adds the new variables.
+    """
+    variables = [v for env in envs.values() for v in env["variables"]]
+    df = df.drop(columns=[v for v in previousVariables if v not in variables and v in df.columns])
+    for table in tables:
+        for v in envs[table]["variables"]: df[v] = np.nan
+    return add_env_columns(df, envs)
+
+
+def order_env_columns(df, envs):
+    """
+    Moves the environmental variable columns to the end of the dataframe, in the order of `envs`.
+    """
+    variables = [v for env in envs.values() for v in env["variables"]]
+    return df[[c for c in df.columns if c not in variables] + variables]
     
 
 def add_env_temporal_coverage(api, envs):
     """
-    Adds new entries to the envs dictionary indicating the temporal coverage of each environmental dataset.
+    Adds new entries to the envs dictionary indicating the temporal coverage (timestamps) of each environmental dataset.
+    The coverage is read from the local metadata cache, which is only refreshed when stale (see metadata.py).
     """
+    metadata = table_metadata(api, list(envs))
     for table, env in envs.items():
-        df = api.query(f"SELECT MIN([time]) startTime, MAX([time]) endTime FROM {table}")
-        if len(df) > 0:
-            envs[table]["startTime"] = df.loc[0, "startTime"]
-            envs[table]["endTime"] = df.loc[0, "endTime"]
+        entry = metadata[table]
+        if entry is not None and entry["startTime"] is not None:
+            envs[table]["startTime"], envs[table]["endTime"] = parse_times([entry["startTime"], entry["endTime"]])
     return envs
 
 
-def match(df, api, envs, cyanoFile, rowCount):
-    """
-    Takes a single-row dataframe containing cyano observations and colocalizes with the 
-    environmental variables included in the `envs` argument. The tolerance parametrs 
-    are also included in the `envs` argument.
-    """ 
-    def get_month(dt):
-        return parse(dt).month
-
-    def shift_dt(dt, delta):
-        delta = float(delta)
-        dt = parse(dt)
-        dt += datetime.timedelta(days=delta)
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
-
-    def in_time_window(sourceDT, targetMinDT, targetMaxDT):
-        targetMinDT = targetMinDT.split(".000Z")[0]
-        targetMaxDT = targetMaxDT.split(".000Z")[0]
-        return not (
-                    parse(sourceDT) < parse(targetMinDT) or 
-                    parse(sourceDT) > parse(targetMaxDT)
-                    )
-
-    def construc_query(table, env, t, lat, lon, depth):
-        variables = env["variables"] 
-        timeTolerance = env["tolerances"][0] 
-        latTolerance = env["tolerances"][1] 
-        lonTolerance = env["tolerances"][2]  
-        depthTolerance = env["tolerances"][3]  
-        hasDepth = env["hasDepth"] 
-        isClimatology = env["isClimatology"]
-        inTimeRange = True
-        if not isClimatology:
-            startTime = env["startTime"]
-            endTime = env["endTime"]    
-            inTimeRange = in_time_window(t, startTime, endTime)
-        selectClause = "SELECT " + ", ".join([f"AVG({v}) {v}" for v in variables]) + " FROM " + table
-        timeClause = f" WHERE [time] BETWEEN '{shift_dt(t, -timeTolerance)}' AND '{shift_dt(t, timeTolerance)}' "
-        if not inTimeRange or isClimatology: timeClause = f" WHERE [month]={get_month(t)} "
-        latClause = f" AND lat BETWEEN {lat-latTolerance} AND {lat+latTolerance} "
-        lonClause = f" AND lon BETWEEN {lon-lonTolerance} AND {lon+lonTolerance} "
-        depthClause = f" AND depth BETWEEN {depth-depthTolerance} AND {depth+depthTolerance} "
+def parse_times(times):
+    """
+    Parses a series of datetime strings (or datetimes) into timezone-naive datetime64[ns] values (UTC wall time).
+    """
+    return pd.to_datetime(pd.Series(times), utc=True).dt.tz_localize(None).astype("datetime64[ns]")
+
+
+def shift_times(t, delta):
+    """
+    Shifts the datetime64 series `t` by `delta` days and returns the results as datetime strings.
+    """
+    return (t + pd.Timedelta(days=float(delta))).dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def in_coverage(t, env):
+    """
+    Returns a boolean array indicating which of the datetimes `t` fall within the temporal coverage of the 
+    environmental dataset `env`. Climatology datasets are never matched by time.
+    """
+    if env["isClimatology"]: return np.zeros(len(t), dtype=bool)
+    return ((t >= env["startTime"]) & (t <= env["endTime"])).to_numpy()
+
+
+def construc_queries(table, env, t, lat, lon, depth):
+    """
+    Returns the SQL queries averaging the variables of the environmental `table` within the tolerance window 
+    around each observation, where `t` is a datetime64 series and `lat`, `lon`, and `depth` are arrays. 
+    Observations outside the temporal coverage of the table (and all climatology lookups) are matched by month.
+    """
+    variables = env["variables"] 
+    timeTolerance = env["tolerances"][0] 
+    latTolerance = env["tolerances"][1] 
+    lonTolerance = env["tolerances"][2]  
+    depthTolerance = env["tolerances"][3]  
+    hasDepth = env["hasDepth"] 
+    byMonth = ~in_coverage(t, env)
+    timeLows, timeHighs = shift_times(t, -timeTolerance).tolist(), shift_times(t, timeTolerance).tolist()
+    months = t.dt.month.astype("Int64").tolist()
+    selectClause = "SELECT " + ", ".join([f"AVG({v}) {v}" for v in variables]) + " FROM " + table
+    queries = []
+    for i, (timeLow, timeHigh, month) in enumerate(zip(timeLows, timeHighs, months)):
+        timeClause = f" WHERE [time] BETWEEN '{timeLow}' AND '{timeHigh}' "
+        if byMonth[i]: timeClause = f" WHERE [month]={month} "
+        latClause = f" AND lat BETWEEN {lat[i]-latTolerance} AND {lat[i]+latTolerance} "
+        lonClause = f" AND lon BETWEEN {lon[i]-lonTolerance} AND {lon[i]+lonTolerance} "
+        depthClause = f" AND depth BETWEEN {depth[i]-depthTolerance} AND {depth[i]+depthTolerance} "
         if not hasDepth: depthClause = ""                
-        return selectClause + timeClause + latClause + lonClause + depthClause        
+        queries.append(selectClause + timeClause + latClause + lonClause + depthClause)
+    return queries
 
 
-    if len(df) != 1: halt(f"Invalid dataframe input.\nExpected a single row dataframe but received {len(df)} rows.")
-    rowIndex = df.index.values[0]
-    df.reset_index(drop=True, inplace=True)
-    t= df.iloc[0]["time"]
-    lat = df.iloc[0]["lat"]
-    lon = df.iloc[0]["lon"] 
-    depth = 0
-    if 'depth' in df.columns: depth = df.iloc[0]["depth"]
+def plan_queries(df, envs, journal=None):
+    """
+    Builds the per-row query (see `construc_queries`) of every pending (row, table) pair of the `df` dataframe and 
+    collapses the duplicates: rows sharing timestamps and grid cells, or climatology lookups, often map to identical queries.
+    Returns a dict mapping each table to a dict of {query: [row indices]}. Matches already recorded in the 
+    `journal` (if any) are filled in the dataframe and left out of the plan, as are the observations with a missing 
+    time or location (left unmatched).
+    """
+    t = parse_times(df["time"])
+    lat = df["lat"].to_numpy(dtype=float)
+    lon = df["lon"].to_numpy(dtype=float)
+    depth = np.zeros(len(df))
+    if 'depth' in df.columns: depth = df["depth"].to_numpy(dtype=float)
+    located = t.notna().to_numpy() & np.isfinite(lat) & np.isfinite(lon)
+    plan = {}
     for table, env in envs.items():
-        print(f"{rowIndex} / {rowCount-1}\n\t{datetime.datetime.now()}: Colocalizing {table} with {cyanoFile} ...")
-        query = construc_query(table, env, t, lat, lon, depth)
-        matchedEnv = api.query(query)
-        if len(matchedEnv)>0:
-            for v in env["variables"]: df.at[0, v] = matchedEnv.iloc[0][v] 
+        variables = env["variables"]
+        done = {} if journal is None else completed(journal, table, variables)
+        for row, values in done.items():
+            for v, value in zip(variables, values): set_values(df, row, v, value)
+        valid = located & np.isfinite(depth) if env["hasDepth"] else located
+        plan[table] = {}
+        for i, query in enumerate(construc_queries(table, env, t, lat, lon, depth)):
+            if i in done or not valid[i]: continue
+            plan[table].setdefault(query, []).append(i)
+    return plan
+
+
+def submit_queries(api, queries, tables):
+    """
+    Executes a list of queries and returns the resulting dataframes in the same order, 
+    either by the asyncio engine (if `ASYNC_COLOCALIZE`) or by a pool of threads sharing the `api` object.
+    The metrics of each query are recorded under its table (`tables` is parallel to `queries`).
+    """
+    if ASYNC_COLOCALIZE: return run_queries(queries, labels=[("colocalize", table) for table in tables])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(lambda query, table: timed_query("colocalize", table, api.query, query), queries, tables))
+
+
+def mark_failed(failed, table, rows):
+    """
+    Adds the rows whose match with `table` failed (after retries) to the `failed` dict of {table: set of row positions}, if any.
+    Failed rows are left unmatched and are not journaled, so that a resumed run queries them again.
+    """
+    count("colocalize", table, "failedRows", len(rows))
+    if failed is not None: failed.setdefault(table, set()).update(int(row) for row in rows)
+    return
+
+
+def match_rows(df, api, envs, cyanoFile, journal=None, failed=None):
+    """
+    Colocalizes all observations in the `df` dataframe with the environmental variables included in the `envs` argument,
+    with one SQL query per row (see `construc_queries`). Each unique query is submitted once (in chunks of `CHUNK_ROWS` 
+    queries) and its result is fanned back to all rows sharing it. Matches already recorded in the `journal` (if any) are skipped.
+    An `AVG` query returns exactly one row when it succeeds: the rows of a query returning no row are reported in `failed` 
+    (see `mark_failed`) instead of being matched.
+    """
+    df = df.reset_index(drop=True)
+    plan = plan_queries(df, envs, journal)
+    tasks = []
+    for table, queries in plan.items():
+        rowCount = sum(len(rows) for rows in queries.values())
+        count("colocalize", table, "uniqueQueries", len(queries))
+        if rowCount > 0: print(f"{table}: {rowCount} row queries -> {len(queries)} unique queries (dedup ratio {rowCount / len(queries):.2f}, {100 * (1 - len(queries) / rowCount):.1f}% saved)")
+        tasks += [(table, envs[table]["variables"], query, rows) for query, rows in queries.items()]
+    print(f"{datetime.datetime.now()}: Colocalizing {cyanoFile} ({len(tasks)} queries) ...")
+    for start in range(0, len(tasks), CHUNK_ROWS):
+        chunk = tasks[start:start+CHUNK_ROWS]
+        results = submit_queries(api, [task[2] for task in chunk], [task[0] for task in chunk])
+        for (table, variables, _, rows), matchedEnv in zip(chunk, results):
+            if len(matchedEnv) < 1:
+                mark_failed(failed, table, rows)
+                continue
+            with timed("colocalize", table, "assembly"):
+                values = [matchedEnv.iloc[0][v] for v in variables]
+                for v, value in zip(variables, values): set_values(df, rows, v, value)
+                if journal is not None: record(journal, rows, table, variables, [values] * len(rows))
+            count("colocalize", table, "rows", len(rows))
+        progress(f"Colocalizing {cyanoFile} (queries)", start + len(chunk), len(tasks))
     return df
 
 
+def restore_completed(df, journal, table, variables):
+    """
+    Fills the `df` dataframe with the matches of `table` already recorded in the `journal` (if any), and returns
+    a boolean array indicating which rows are still pending.
+    """
+    pending = np.ones(len(df), dtype=bool)
+    if journal is None: return pending
+    done = completed(journal, table, variables)
+    for row, values in done.items():
+        for v, value in zip(variables, values): set_values(df, row, v, value)
+    pending[list(done)] = False
+    return pending
+
 
-def main():
+def tile_keys(t, lat, lon, byMonth):
     """
-    Iterates through the list of cyano datasets and colocalizes them with the specified environmentl variables.
-    Colocalized datasets are stored in the "COLOCALIZED_DIR" as csv files.
+    Assigns each observation to a space-time tile and returns a dict mapping the tile keys to row positions.
+    Rows matched by time are binned by `TILE_SIZE[0]` days, and rows falling back to the climatology 
+    `[month]` lookup are binned by month. Rows with missing time or location are left out.
     """
-    def saveColocalizedCSV(df):
-        df.to_csv(f"{COLOCALIZED_DIR}{os.path.basename(cyanoFile)}", index=False) 
+    days = (t - pd.Timestamp(0)) / pd.Timedelta(days=1)
+    keys = pd.DataFrame({
+                         "byMonth": byMonth,
+                         "time": np.where(byMonth, t.dt.month, np.floor(days / TILE_SIZE[0])),
+                         "lat": np.floor(lat / TILE_SIZE[1]),
+                         "lon": np.floor(lon / TILE_SIZE[2])
+                         })
+    return keys.groupby(list(keys.columns)).indices
 
-    cyanoFiles = cyano_csv_files(DATA_DIR)
-    api = pycmap.API(token=API_KEY)
-    makedir(COLOCALIZED_DIR)
-    envs = environmental_datasets()        
-    envs = add_env_temporal_coverage(api, envs)
 
-    for cyanoFile in cyanoFiles:
-        df = pd.read_csv(cyanoFile)
-        df = add_env_columns(df, envs)
-        dfs = [df.loc[i].to_frame().T for i in range(len(df))]
-        colocalizedDF  = pd.DataFrame({})
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futureObjs = executor.map(match, dfs, [api] * len(dfs), [envs] * len(dfs), [cyanoFile] * len(dfs), [len(dfs)] * len(dfs))
-            for fo in futureObjs:
-                if len(colocalizedDF) < 1:
-                    colocalizedDF = fo
+def cell_version(env, cell):
+    """
+    Returns the version of a cache cell (see `cache.cell_name`) of the environmental dataset `env`.
+    Near real-time tables keep growing: a cell whose time bucket reaches the end of the temporal coverage of the table,
+    or a `[month]` lookup (which spans the whole table), is versioned by that coverage end, so that it is fetched again 
+    once the table grows. Cells ending before the coverage end, and the cells of tables without a temporal coverage 
+    (climatologies), are final.
+    """
+    if "endTime" not in env: return "final"
+    byMonth, timeBucket = cell[0], cell[1]
+    if not byMonth and pd.Timestamp(0) + pd.Timedelta(days=(timeBucket + 1) * TILE_SIZE[0]) <= env["endTime"]: return "final"
+    return env["endTime"].strftime("%Y%m%dT%H%M%S")
+
+
+def fetch_cell(api, table, env, cell):
+    """
+    Retrieves the environmental records of `table` that fall within a cache cell (see `cache.cell_name`).
+    The local cache is consulted first (see `cell_version`); on a cache miss the cell is queried from CMAP and cached, 
+    unless running in offline mode. A failed query (exception or missing columns) is retried with jittered exponential 
+    backoff; None is returned if it keeps failing.
+    """
+    variables = env["variables"]
+    coords = ["month" if cell[0] else "time", "lat", "lon"] + (["depth"] if env["hasDepth"] else [])
+    version = cell_version(env, cell)
+    with timed("colocalize", table, "cache"):
+        df = cache_get(table, variables, coords, cell, version)
+    if df is not None: 
+        count("colocalize", table, "cacheHits")
+        return df
+    count("colocalize", table, "cacheMisses")
+    if OFFLINE: halt(f"Cache miss in offline mode:\n{table} {variables} {cell_name(cell)}")
+    byMonth, timeBucket, latTile, lonTile, depthBand = cell
+    selectClause = "SELECT " + ", ".join([f"[{coords[0]}]"] + coords[1:] + variables) + " FROM " + table
+    if byMonth: 
+        timeClause = f" WHERE [month]={timeBucket} "
+    else:    
+        startTime = pd.Timestamp(0) + pd.Timedelta(days=timeBucket * TILE_SIZE[0])
+        endTime = startTime + pd.Timedelta(days=TILE_SIZE[0])
+        timeClause = f" WHERE [time] >= '{startTime.strftime('%Y-%m-%d %H:%M:%S')}' AND [time] < '{endTime.strftime('%Y-%m-%d %H:%M:%S')}' "
+    latClause = f" AND lat >= {latTile * TILE_SIZE[1]} AND lat < {(latTile + 1) * TILE_SIZE[1]} "
+    lonClause = f" AND lon >= {lonTile * TILE_SIZE[2]} AND lon < {(lonTile + 1) * TILE_SIZE[2]} "
+    depthClause = ""
+    if env["hasDepth"]: depthClause = f" AND depth >= {depthBand * TILE_SIZE[3]} AND depth < {(depthBand + 1) * TILE_SIZE[3]} "
+    query = selectClause + timeClause + latClause + lonClause + depthClause
+    error = ""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            df = timed_query("colocalize", table, api.query, query)
+            if set(coords + variables).issubset(df.columns): break
+            error = f"unexpected columns {list(df.columns)}"
+        except Exception as e:
+            error = repr(e)
+        if attempt < MAX_RETRIES: 
+            count("colocalize", table, "retries")
+            time.sleep(backoff(attempt))
+    else:
+        print(f"Cell query failed after {MAX_RETRIES + 1} attempts ({error}):\n{query}", file=sys.stderr)
+        return None
+    with timed("colocalize", table, "cache"):
+        cache_put(table, variables, coords, cell, version, df)
+    return df
+
+
+def fetch_region(api, table, env, byMonth, timeBounds, latBounds, lonBounds, depthBounds):
+    """
+    Retrieves the environmental records of `table` within the cache cells that cover the bounding box of a tile.
+    `timeBounds` is a pair of timestamps, or a single month number if `byMonth` is True.
+    Returns None if any of the cells cannot be retrieved (see `fetch_cell`).
+    """
+    def span(bounds, size):
+        return range(int(np.floor(bounds[0] / size)), int(np.floor(bounds[1] / size)) + 1)
+
+    if byMonth: 
+        timeBuckets = [timeBounds]
+    else:
+        timeBuckets = span([(tb - pd.Timestamp(0)) / pd.Timedelta(days=1) for tb in timeBounds], TILE_SIZE[0])
+    depthBands = span(depthBounds, TILE_SIZE[3]) if env["hasDepth"] else [None]
+    cells = itertools.product([byMonth], timeBuckets, span(latBounds, TILE_SIZE[1]), span(lonBounds, TILE_SIZE[2]), depthBands)
+    frames = [fetch_cell(api, table, env, cell) for cell in cells]
+    if any(f is None for f in frames): return None
+    frames = [f for f in frames if len(f) > 0]
+    if len(frames) < 1: return pd.DataFrame({})
+    return pd.concat(frames, ignore_index=True)
+
+
+def box_coords(points, cols):
+    """
+    Returns a dict mapping the coordinate columns of the `points` dataframe to numeric arrays (int64 nanoseconds for times).
+    """
+    coords = {}
+    for col in cols:
+        if col == "time": coords[col] = parse_times(points[col]).to_numpy().view("int64")
+        else: coords[col] = points[col].to_numpy(dtype=float)
+    return coords
+
+
+def box_average(points, boxes, variables):
+    """
+    Averages the `variables` of the `points` dataframe within each of the given boxes.
+    `boxes` maps a coordinate column of `points` to a pair of arrays holding the inclusive lower and upper bounds of each box.
+    Null values are ignored and empty boxes yield NaN, in line with the SQL `AVG ... BETWEEN` semantics.
+    With `AVERAGE_BACKEND = "grid"` the averages are answered by a bin index (see gridindex.py), otherwise 
+    every box is compared with every point.
+    """
+    boxCount = len(next(iter(boxes.values()))[0])
+    averages = np.full((boxCount, len(variables)), np.nan)
+    if len(points) < 1: return averages
+    values = points[variables].to_numpy(dtype=float)
+    coords = box_coords(points, boxes)
+    if AVERAGE_BACKEND == "grid": return grid_average(coords, values, boxes)
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+    step = max(1, MAX_MASK_SIZE // len(points))
+    for start in range(0, boxCount, step):
+        end = min(start + step, boxCount)
+        mask = np.ones((end - start, len(points)), dtype=bool)
+        for col, (low, high) in boxes.items():
+            mask &= (coords[col] >= low[start:end, None]) & (coords[col] <= high[start:end, None])
+        mask = mask.astype(float)
+        sums, counts = mask @ values, mask @ valid
+        with np.errstate(invalid="ignore", divide="ignore"):
+            averages[start:end] = np.where(counts > 0, sums / counts, np.nan)
+    return averages
+
+
+def match_batch(df, api, envs, cyanoFile, journal=None, failed=None):
+    """
+    Colocalizes all observations in the `df` dataframe with the environmental variables included in the `envs` argument.
+    Rows are grouped into space-time tiles and each environmental table is retrieved once per tile for the tile's 
+    bounding box (extended by the tolerances), through the local cache. The tolerance-window averages are then computed locally, following 
+    the same rules as the per-row queries (see `construc_queries`, including the climatology `[month]` fallback).
+    Rows already matched in the `journal` (if any) are skipped, and each completed tile is recorded.
+    The rows of a tile whose environmental data cannot be retrieved are reported in `failed` (see `mark_failed`).
+    """
+    df = df.reset_index(drop=True)
+    t = parse_times(df["time"])
+    lat = df["lat"].to_numpy(dtype=float)
+    lon = df["lon"].to_numpy(dtype=float)
+    depth = np.zeros(len(df))
+    if 'depth' in df.columns: depth = df["depth"].to_numpy(dtype=float)
+    for table, env in envs.items():
+        variables = env["variables"]
+        timeTolerance, latTolerance, lonTolerance, depthTolerance = env["tolerances"]
+        byMonth = ~in_coverage(t, env)
+        # time bounds are truncated to whole seconds, as formatted by `shift_times` in the per-row queries
+        timeDelta = pd.Timedelta(days=float(timeTolerance))
+        timeLow, timeHigh = (t - timeDelta).dt.floor("s"), (t + timeDelta).dt.floor("s")
+        latLow, latHigh = lat - latTolerance, lat + latTolerance
+        lonLow, lonHigh = lon - lonTolerance, lon + lonTolerance
+        depthLow, depthHigh = depth - depthTolerance, depth + depthTolerance
+        pending = restore_completed(df, journal, table, variables)
+        tiles = tile_keys(t, lat, lon, byMonth)
+        label = f"Colocalizing {table} with {cyanoFile} (tiles)"
+        for i, (key, rows) in enumerate(tiles.items()):
+            progress(label, i, len(tiles))
+            rows = rows[pending[rows]]
+            if len(rows) < 1: continue
+            tileByMonth = key[0]
+            if tileByMonth:
+                month = int(key[1])
+                timeBounds = month
+                boxes = {"month": (np.full(len(rows), month), np.full(len(rows), month))}
+            else:
+                low, high = timeLow.iloc[rows], timeHigh.iloc[rows]
+                timeBounds = (low.min(), high.max())
+                boxes = {"time": (low.to_numpy().view("int64"), high.to_numpy().view("int64"))}
+            boxes["lat"] = (latLow[rows], latHigh[rows])
+            boxes["lon"] = (lonLow[rows], lonHigh[rows])
+            if env["hasDepth"]: boxes["depth"] = (depthLow[rows], depthHigh[rows])
+            region = fetch_region(
+                                  api, 
+                                  table, 
+                                  env, 
+                                  tileByMonth, 
+                                  timeBounds, 
+                                  (latLow[rows].min(), latHigh[rows].max()), 
+                                  (lonLow[rows].min(), lonHigh[rows].max()), 
+                                  (depthLow[rows].min(), depthHigh[rows].max())
+                                  )
+            if region is None:
+                mark_failed(failed, table, rows)
+                continue
+            with timed("colocalize", table, "aggregation"):
+                averages = box_average(region, boxes, variables)
+            with timed("colocalize", table, "assembly"):
+                for j, v in enumerate(variables): set_values(df, rows, v, averages[:, j])
+                if journal is not None: record(journal, rows, table, variables, averages)
+            count("colocalize", table, "rows", len(rows))
+        progress(label, len(tiles), len(tiles))
+    return df
+
+
+
+def supports_set_queries(api):
+    """
+    Probes whether the server accepts the set-based queries of `match_blocks` (a common table expression built from a
+    UNION ALL of constant rows).
+    """
+    df = api.query("WITH p(pointId, x) AS (SELECT 0, 1.5 UNION ALL SELECT 1, 2.5) SELECT pointId, x FROM p")
+    return "pointId" in df.columns and len(df) == 2
+
+
+def construc_block_query(table, env, block, byMonth, t, lat, lon, depth):
+    """
+    Returns a single SQL query matching a block of observations (row positions `block`) with the environmental `table`.
+    The tolerance windows of the observations are sent as a UNION ALL of constant rows (a form accepted by T-SQL and
+    SQLite alike, unlike a VALUES list in a common table expression) and joined with the table, so that the server
+    averages the variables of every window in one pass. The result holds one row per matched observation, identified by
+    its position in the block (`pointId`). Windows are bounded by time, or by `[month]` if `byMonth` is True, following
+    the same predicates as the per-row queries (see `construc_queries`).
+    """
+    variables = env["variables"]
+    timeTolerance, latTolerance, lonTolerance, depthTolerance = env["tolerances"]
+    columns = ["pointId", "month"] if byMonth else ["pointId", "timeLow", "timeHigh"]
+    columns += ["latLow", "latHigh", "lonLow", "lonHigh"] + (["depthLow", "depthHigh"] if env["hasDepth"] else [])
+    times = t.iloc[block]
+    if byMonth:
+        timeValues = [[str(month)] for month in times.dt.month.tolist()]
+    else:
+        timeValues = [[f"'{low}'", f"'{high}'"] for low, high in zip(shift_times(times, -timeTolerance), shift_times(times, timeTolerance))]
+    points = []
+    for i, row in enumerate(block):
+        values = [str(i)] + timeValues[i]
+        values += [f"{lat[row]-latTolerance}", f"{lat[row]+latTolerance}", f"{lon[row]-lonTolerance}", f"{lon[row]+lonTolerance}"]
+        if env["hasDepth"]: values += [f"{depth[row]-depthTolerance}", f"{depth[row]+depthTolerance}"]
+        points.append("SELECT " + ", ".join(values))
+    predicates = ["e.[month] = p.month"] if byMonth else ["e.[time] BETWEEN p.timeLow AND p.timeHigh"]
+    predicates += ["e.lat BETWEEN p.latLow AND p.latHigh", "e.lon BETWEEN p.lonLow AND p.lonHigh"]
+    if env["hasDepth"]: predicates.append("e.depth BETWEEN p.depthLow AND p.depthHigh")
+    return (
+            f"WITH p({', '.join(columns)}) AS ({' UNION ALL '.join(points)}) "
+            f"SELECT p.pointId, " + ", ".join([f"AVG(e.{v}) {v}" for v in variables]) + 
+            f" FROM p JOIN {table} e ON " + " AND ".join(predicates) + " GROUP BY p.pointId"
+            )
+
+
+def block_queries(table, env, rows, byMonth, t, lat, lon, depth):
+    """
+    Splits the observations (row positions `rows`) into blocks and returns a list of (block, query) pairs (see `construc_block_query`).
+    Blocks hold at most `BLOCK_ROWS` observations, and fewer if needed to keep the url-encoded query within `MAX_QUERY_LENGTH`
+    characters, as the query is sent in the url of a GET request.
+    """
+    pairs, start, size = [], 0, BLOCK_ROWS
+    while start < len(rows):
+        while True:
+            block = rows[start:start+size]
+            query = construc_block_query(table, env, block, byMonth, t, lat, lon, depth)
+            length = len(urlencode({"query": query}))
+            if length <= MAX_QUERY_LENGTH or size == 1: break
+            size = max(1, min(size - 1, size * MAX_QUERY_LENGTH // length))
+        pairs.append((block, query))
+        start += len(block)
+    return pairs
+
+
+def match_blocks(df, api, envs, cyanoFile, journal=None, failed=None):
+    """
+    Colocalizes all observations in the `df` dataframe with the environmental variables included in the `envs` argument,
+    by sending blocks of observations to the server in one set-based query per block and table 
+    (see `block_queries`). Observations with a missing time or location are left unmatched.
+    A block whose query fails is colocalized on the client side instead (see `match_batch`), whose failed rows are
+    reported in `failed` (see `mark_failed`).
+    Rows already matched in the `journal` (if any) are skipped, and each completed block is recorded.
+    """
+    df = df.reset_index(drop=True)
+    t = parse_times(df["time"])
+    lat = df["lat"].to_numpy(dtype=float)
+    lon = df["lon"].to_numpy(dtype=float)
+    depth = np.zeros(len(df))
+    if 'depth' in df.columns: depth = df["depth"].to_numpy(dtype=float)
+    for table, env in envs.items():
+        variables = env["variables"]
+        pending = restore_completed(df, journal, table, variables)
+        pending &= t.notna().to_numpy() & np.isfinite(lat) & np.isfinite(lon)
+        if env["hasDepth"]: pending &= np.isfinite(depth)
+        byMonth = ~in_coverage(t, env)
+        blocks = []
+        for flag in [False, True]:
+            rows = np.flatnonzero(pending & (byMonth == flag))
+            blocks += block_queries(table, env, rows, flag, t, lat, lon, depth)
+        label = f"Colocalizing {table} with {cyanoFile} (blocks)"
+        for start in range(0, len(blocks), MAX_WORKERS):
+            progress(label, start, len(blocks))
+            chunk = blocks[start:start+MAX_WORKERS]
+            queries = [query for _, query in chunk]
+            for (block, _), matchedEnv in zip(chunk, submit_queries(api, queries, [table] * len(queries))):
+                if "pointId" in matchedEnv.columns:
+                    averages = np.full((len(block), len(variables)), np.nan)
+                    averages[matchedEnv["pointId"].to_numpy(dtype=int)] = matchedEnv[variables].to_numpy(dtype=float)
                 else:
-                    colocalizedDF = pd.concat([colocalizedDF, fo], ignore_index=True)  
-        saveColocalizedCSV(colocalizedDF)
+                    count("colocalize", table, "blockFallbacks")
+                    blockFailed = {}
+                    averages = match_batch(df.loc[block].copy(), api, {table: env}, cyanoFile, failed=blockFailed)[variables].to_numpy(dtype=float)
+                    matched = np.ones(len(block), dtype=bool)
+                    matched[list(blockFailed.get(table, []))] = False
+                    if failed is not None and not matched.all(): failed.setdefault(table, set()).update(int(row) for row in block[~matched])
+                    block, averages = block[matched], averages[matched]
+                with timed("colocalize", table, "assembly"):
+                    for j, v in enumerate(variables): set_values(df, block, v, averages[:, j])
+                    if journal is not None: record(journal, block, table, variables, averages)
+                count("colocalize", table, "rows", len(block))
+        progress(label, len(blocks), len(blocks))
+    return df
+
+
+def select_matcher(api):
+    """
+    Returns the colocalization function selected in settings.py: `match_blocks` if `SET_BASED_COLOCALIZE` (and the
+    server supports it), otherwise `match_batch` if `BATCH_COLOCALIZE`, and `match_rows` if not.
+    In `OFFLINE` mode, only `match_batch` can work from the local cache, whatever the settings.
+    """
+    if OFFLINE:
+        if SET_BASED_COLOCALIZE or not BATCH_COLOCALIZE: print("Offline mode: colocalizing from the local cache (client-side batching).")
+        return match_batch
+    if SET_BASED_COLOCALIZE:
+        if supports_set_queries(api): return match_blocks
+        print("The server does not support set-based queries; falling back to client-side batching.")
+        return match_batch
+    if BATCH_COLOCALIZE: return match_batch
+    return match_rows
+
+
+
+def file_plan(cyanoFile, envs, manifest, fingerprints):
+    """
+    Returns what remains to be done for a cyano file: its name, colocalized file path, content hash, the environmental
+    tables to be matched, and whether its existing colocalized file is refreshed. With `INCREMENTAL`, a file whose content
+    is unchanged is only matched with the tables whose configuration or temporal coverage changed (see manifest.py).
+    """
+    name = os.path.splitext(os.path.basename(cyanoFile))[0]
+    colocalizedFile = data_path(COLOCALIZED_DIR, name)
+    sourceHash = file_hash(cyanoFile)
+    entry = manifest["colocalize"].get(name)
+    plan = {"name": name, "colocalizedFile": colocalizedFile, "source": sourceHash, "tables": list(envs), "refresh": False}
+    if INCREMENTAL and entry is not None and entry["source"] == sourceHash and os.path.isfile(colocalizedFile):
+        plan["tables"] = [table for table in envs if entry["tables"].get(table) != fingerprints[table]]
+        plan["refresh"] = True
+    return plan
+
+
+def base_frame(cyanoFile, plan, envs, manifest):
+    """
+    Returns the dataframe to be filled with the matches of the tables in the `plan` (see `file_plan`).
+    """
+    if plan["refresh"]:
+        return refresh_env_columns(read_data(plan["colocalizedFile"]), envs, plan["tables"], manifest["colocalize"][plan["name"]]["variables"])
+    return add_env_columns(read_data(cyanoFile), envs)
+
+
+def record_file(manifest, plan, envs, fingerprints):
+    """
+    Records a colocalized file in the manifest.
+    """
+    manifest["colocalize"][plan["name"]] = {
+                                            "source": plan["source"], 
+                                            "variables": [v for env in envs.values() for v in env["variables"]], 
+                                            "tables": fingerprints
+                                            }
+    save_manifest(manifest)
+    return
+
+
+def work_units(rowCount, tables):
+    """
+    Returns the (first row, table) work units of a cyano file: each table is matched in row ranges of `SHARD_ROWS` rows.
+    """
+    return [(start, table) for table in tables for start in range(0, rowCount, SHARD_ROWS)]
+
+
+def shard_of(name, start, table, shardCount):
+    """
+    Returns the shard (0 .. shardCount-1) of a work unit. The assignment is a stable hash of the unit key, 
+    so that every process and host agrees on it without coordination.
+    """
+    return zlib.crc32(f"{name}|{start}|{table}".encode()) % shardCount
+
+
+def shard_dir(plan):
+    """
+    Returns the directory holding the partial outputs of a cyano file, specific to the file content.
+    """
+    return f"{SHARDS_DIR}{plan['name']}_{plan['source'][:12]}/"
+
+
+def unit_path(plan, start, table, fingerprints):
+    """
+    Returns the path to the partial output of a work unit, specific to the table configuration (see manifest.py).
+    """
+    return data_path(shard_dir(plan), f"{table}_{fingerprints[table][:12]}_{start}")
+
+
+def colocalize_shard(api, envs, cyanoFiles, manifest, fingerprints, matcher, shardIndex, shardCount):
+    """
+    Colocalizes the work units (see `work_units`) assigned to shard `shardIndex` out of `shardCount`. 
+    Each unit is written to its own partial output (the variables of one table for one row range), so that 
+    a re-run of the shard skips the finished units. The partial outputs are assembled by `merge_shards`.
+    The cache is trimmed (see `evict`) after each unit, as a shard may run for a long time.
+    A unit with failed matches (see `mark_failed`) is not written, so that it is retried by the next run of the shard.
+    """
+    for cyanoFile in cyanoFiles:
+        plan = file_plan(cyanoFile, envs, manifest, fingerprints)
+        if len(plan["tables"]) < 1: continue
+        df = add_env_columns(read_data(cyanoFile), envs)
+        units = [(start, table) for start, table in work_units(len(df), plan["tables"]) 
+                 if shard_of(plan["name"], start, table, shardCount) == shardIndex and not os.path.isfile(unit_path(plan, start, table, fingerprints))]
+        makedir(shard_dir(plan))
+        for i, (start, table) in enumerate(units):
+            variables = envs[table]["variables"]
+            failed = {}
+            matched = matcher(df.iloc[start:start + SHARD_ROWS], api, {table: envs[table]}, cyanoFile, failed=failed)
+            if matcher is not match_rows: evict()
+            if len(failed) > 0:
+                print(f"Skipping work unit {table} {start} of {cyanoFile}: {len(failed[table])} rows failed; re-run the shard.")
+                continue
+            path = unit_path(plan, start, table, fingerprints)
+            root, ext = os.path.splitext(path)
+            tmpPath = f"{root}.{os.getpid()}.tmp{ext}"
+            write_data(matched[variables], tmpPath)
+            os.replace(tmpPath, path)
+            progress(f"shard {shardIndex}/{shardCount} {plan['name']}", i + 1, len(units))
+    return
+
+
+def merge_shards(envs, cyanoFiles, manifest, fingerprints):
+    """
+    Assembles the partial outputs of all shards into the colocalized files, which are then the same as those of a single-process run.
+    Halts if any work unit has not been completed yet.
+    """
+    for cyanoFile in cyanoFiles:
+        plan = file_plan(cyanoFile, envs, manifest, fingerprints)
+        if len(plan["tables"]) < 1:
+            print(f"Skipping {cyanoFile} (up to date)")
+            continue
+        df = base_frame(cyanoFile, plan, envs, manifest)
+        units = work_units(len(df), plan["tables"])
+        missing = [unit_path(plan, start, table, fingerprints) for start, table in units if not os.path.isfile(unit_path(plan, start, table, fingerprints))]
+        if len(missing) > 0: halt(f"{len(missing)} of {len(units)} work units of {cyanoFile} are not completed (e.g. {missing[0]}); run the remaining shards before merging.")
+        for start, table in units:
+            part = read_data(unit_path(plan, start, table, fingerprints))
+            rows = np.arange(start, start + len(part))
+            for v in envs[table]["variables"]: set_values(df, rows, v, part[v].to_numpy())
+        write_data(order_env_columns(df, envs), plan["colocalizedFile"])
+        record_file(manifest, plan, envs, fingerprints)
+        for d in glob.glob(f"{SHARDS_DIR}{plan['name']}_*/"): shutil.rmtree(d, ignore_errors=True)
+        print(f"Merged {len(units)} work units of {cyanoFile}")
+    evict()
+    return
+
+
+def run_local_shards(shardCount):
+    """
+    Runs `shardCount` shards as local processes (`colocalize.py --shard i/shardCount`) and waits for all of them.
+    """
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--shard", f"{i}/{shardCount}"]) for i in range(shardCount)]
+    failed = [i for i, p in enumerate(processes) if p.wait() != 0]
+    if len(failed) > 0: halt(f"Shards {failed} failed; re-run them with --shard i/{shardCount} and then --merge.")
+    return
+
+
+def shard_arg(value):
+    """
+    Parses the "i/N" value of the `--shard` argument.
+    """
+    try:
+        shardIndex, shardCount = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value}")
+    if not 0 <= shardIndex < shardCount: raise argparse.ArgumentTypeError(f"shard index out of range: {value}")
+    return shardIndex, shardCount
+
+
+def main():
+    """
+    Iterates through the list of cyano datasets and colocalizes them with the specified environmentl variables.
+    Colocalized datasets are stored in the "COLOCALIZED_DIR" (see `STORAGE_FORMAT`).
+    Completed matches are journaled, so that an interrupted run can be continued with the `--resume` flag.
+    A file with failed matches is saved but kept out of the manifest, along with its journal, so that `--resume` only 
+    queries the failed matches again.
+    With `INCREMENTAL`, files whose content is unchanged are only matched with the environmental tables whose 
+    configuration or temporal coverage changed since the last run (see manifest.py).
+    Per-table metrics of the run are saved in the "METRICS_DIR" (see metrics.py).
+    The work can be split across processes or hosts with `--shard i/N` (see `colocalize_shard`), followed by `--merge`;
+    `--processes N` does both locally.
+    """
+    parser = argparse.ArgumentParser(description="Colocalizes the cyano datasets with environmental variables.")
+    parser.add_argument("--resume", action="store_true", help="skip the matches completed by a previous (interrupted) run.")
+    parser.add_argument("--profile", action="store_true", help="run under cProfile and save the profile next to the metrics.")
+    parser.add_argument("--shard", type=shard_arg, metavar="i/N", help="only colocalize the work units of shard i out of N (see `shard_of`).")
+    parser.add_argument("--merge", action="store_true", help="assemble the outputs of all shards into the colocalized files.")
+    parser.add_argument("--processes", type=int, default=0, metavar="N", help="run N shards as local processes, then merge.")
+    args = parser.parse_args()
+    runName = "colocalize" if args.shard is None else f"colocalize_shard{args.shard[0]}of{args.shard[1]}"
+    with profiled(runName, args.profile):
+        cyanoFiles = cyano_files(DATA_DIR)
+        import pycmap
+        api = pycmap.API(token=API_KEY)
+        makedir(COLOCALIZED_DIR)
+        envs = environmental_datasets()        
+        envs = add_env_temporal_coverage(api, envs)
+        manifest = load_manifest()
+        fingerprints = env_fingerprints(envs)
+        matcher = select_matcher(api)
+        if args.processes > 0:
+            # the table metadata is now fresh on disk, so the shards start without querying it again
+            run_local_shards(args.processes)
+            args.merge = True
+
+        if args.shard is not None:
+            colocalize_shard(api, envs, cyanoFiles, manifest, fingerprints, matcher, *args.shard)
+        elif args.merge:
+            merge_shards(envs, cyanoFiles, manifest, fingerprints)
+        else:
+            for cyanoFile in cyanoFiles:
+                plan = file_plan(cyanoFile, envs, manifest, fingerprints)
+                if not INCREMENTAL and args.resume and os.path.isfile(plan["colocalizedFile"]) and not os.path.isfile(journal_path(cyanoFile)):
+                    print(f"Skipping {cyanoFile} (already colocalized)")
+                    continue
+                if len(plan["tables"]) < 1:
+                    print(f"Skipping {cyanoFile} (up to date)")
+                    continue
+                if plan["refresh"]: print(f"Updating {cyanoFile} with {plan['tables']}")
+                df = base_frame(cyanoFile, plan, envs, manifest)
+                pendingEnvs = {table: envs[table] for table in plan["tables"]}
+                journal = open_journal(cyanoFile, len(df), len(pendingEnvs), reset=not args.resume)
+                report(journal)
+                failed = {}
+                write_data(order_env_columns(matcher(df, api, pendingEnvs, cyanoFile, journal, failed), envs), plan["colocalizedFile"])
+                if matcher is not match_rows: evict()
+                report(journal)
+                close_journal(journal, remove=len(failed) < 1)
+                if len(failed) > 0:
+                    print(f"{cyanoFile}: {sum(len(rows) for rows in failed.values())} matches failed with {list(failed)}; run again with --resume to retry them.")
+                    continue
+                record_file(manifest, plan, envs, fingerprints)
+    save_metrics(runName)
 
 
                     
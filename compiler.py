@@ -3,59 +3,80 @@ Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
 
 Date: 2020-08-22
 
-Function: Compiles all of the colocalized cyano datasets into a single csv file.
+Function: Compiles all of the colocalized cyano datasets into a single file.
 """
 
 
 
-import os, sys, glob
-import pycmap
-from config.config import API_KEY
-from settings import PROC, SYNC, PICO, COLOCALIZED_DIR, COMPILED_DIR
-from common import halt, makedir, env_vars
+import os
+import concurrent.futures
+from collections import deque
+from settings import PROC, SYNC, PICO, COLOCALIZED_DIR, COMPILED_DIR, PARTS_DIR, TRAINING_DIR, STORAGE_FORMAT, EXPORT_CSV, EXPORT_TRAINING, CHUNK_ROWS, COMPILE_WORKERS, INCREMENTAL
+from common import halt, makedir
+from registry import scale_factor, rename_map, compiled_columns as registered_columns
+from storage import data_files, data_path, read_columns, read_data, write_chunks, export_csv, compact, arrow_schema
+from manifest import load_manifest, save_manifest, file_hash
+from training import export_training
+import numpy as np
 import pandas as pd
 
 
 
 
-def scale_factor(table):
+def insert_column(df, colTitle, colIndex, fillValue):
+    """
+    Inserts a new column `colTitle`, to the dataframe `df` at location `colIndex` with initial value `fillValue`.
     """
-    Multiplies the cyano abundance measurements with a constant factor. 
-    For example: 
-    The Seaflow dataset reports the abundance values in units of cell/uL while 
-    all other datasets are in cell/mL. This means that seaflow abundance values 
-    should be multiplied with a 1000 factor.
-    """ 
-    factor = 1
-    table = table.lower()
-    if table.find('seaflow') != -1: factor = 1000
-    return factor
+    if colTitle not in df.columns:
+        df.insert(colIndex, colTitle, fillValue, True)
+    return df    
+
 
+def compiled_columns():
+    """
+    Returns the ordered list of columns of the compiled dataset (see `registry.compiled_columns`).
+    """
+    return list(registered_columns())
 
 
-def rename_cyano_columns(df):
+def standardize_columns(df, table):
     """
-    Renames the cyano abundance column titles to predefined values.
-    """ 
-    cols = list(df.columns)
-    for i, col in enumerate(df.columns):
-        if col.lower().find("pro") != -1 and col.lower().find("abun") != -1:     # prochlorococcus abundance
-            cols[i] = PROC
-        elif col.lower().find("syn") != -1 and col.lower().find("abun") != -1:   # synechococcus abundance
-            cols[i] = SYNC
-        elif col.lower().find("pico") != -1 and col.lower().find("abun") != -1:  # picoeukaryote abundance
-            cols[i] = PICO
-    df.columns = cols        
-    return df.columns        
+    Renames the cyano abundance columns to their standard labels (see `registry.rename_map`) and inserts the missing standard columns.
+    """
+    renames = rename_map(table)
+    df.columns = [renames.get(col, col) for col in df.columns]
+    df = insert_column(df, "depth", 3, 0)
+    df = insert_column(df, "table", 4, table)
+    df = insert_column(df, "cruise", 5, np.nan)
+    df = insert_column(df, PROC, 6, np.nan)
+    df = insert_column(df, SYNC, 7, np.nan)
+    df = insert_column(df, PICO, 8, np.nan)
+    return df
 
 
-def insert_column(df, colTitle, colIndex, fillValue):
+def check_schema(cyanoFile):
     """
-    Inserts a new column `colTitle`, to the dataframe `df` at location `colIndex` with initial value `fillValue`.
+    Checks, by reading the header only, whether a colocalized file can be unified with the others.
+    Returns an error message describing the mismatch, or None if the columns are valid.
     """
-    if colTitle not in df.columns:
-        df.insert(colIndex, colTitle, fillValue, True)
-    return df    
+    table = os.path.splitext(os.path.basename(cyanoFile))[0]
+    columns = list(standardize_columns(pd.DataFrame(columns=read_columns(cyanoFile)), table).columns)
+    expected = compiled_columns()
+    if columns == expected: return None
+    missing = [c for c in expected if c not in columns]
+    unexpected = [c for c in columns if c not in expected]
+    msg = f"{cyanoFile}:\n\tmissing: {missing}\n\tunexpected: {unexpected}"
+    if len(missing) + len(unexpected) == 0: msg += "\n\tcolumns out of order"
+    return msg
+
+
+def check_schemas(cyanoFiles):
+    """
+    Checks the columns of all colocalized files up front and terminates the program reporting every mismatch at once.
+    """
+    errors = [e for e in map(check_schema, cyanoFiles) if e is not None]
+    if len(errors) > 0: halt(f"Invalid columns in {len(errors)} file(s):\n" + "\n".join(errors))
+    return
 
 
 def unify(cyanoFile):
@@ -63,20 +84,11 @@ def unify(cyanoFile):
     Takes a colocalized cyano filepath and ensures that it will have identical columns as other colocalized files.
     It also ensures that all cyano observations are in the same units [cell/ml].
     """
-    # columns:
-    # time | lat | lon | depth | table | cruise | <PROC> | <SYNC> | <PICO> | env_var1 | ... | env_var_n     
-    df = pd.read_csv(cyanoFile)
+    df = read_data(cyanoFile)
     table = os.path.splitext(os.path.basename(cyanoFile))[0]
-    df.columns = rename_cyano_columns(df)
+    df = standardize_columns(df, table)
 
-    df = insert_column(df, "depth", 3, 0)
-    df = insert_column(df, "table", 4, table)
-    df = insert_column(df, "cruise", 5, None)
-    df = insert_column(df, PROC, 6, None)
-    df = insert_column(df, SYNC, 7, None)
-    df = insert_column(df, PICO, 8, None)
-
-    columns = ["time", "lat", "lon", "depth", "table", "cruise", PROC, SYNC, PICO] + env_vars()
+    columns = compiled_columns()
     if list(df.columns) != columns:    
         print(df.columns)
         halt(f"Invalid columns:\n{cyanoFile}")
@@ -86,16 +98,65 @@ def unify(cyanoFile):
     df[SYNC] = factor * df[SYNC]
     df[PICO] = factor * df[PICO]
 
-    df = df[columns]
+    df = compact(df[columns])
     return df
 
-     
+
+def compiled_schema():
+    """
+    Returns the arrow schema of the compiled dataset, so that all colocalized files are written with consistent types
+    (see `storage.column_dtype`).
+    """
+    return arrow_schema(compiled_columns())
+
+
+def unify_all(cyanoFiles, workers):
+    """
+    Unifies the colocalized files concurrently with a pool of `workers` processes and yields the unified 
+    dataframes in the order of `cyanoFiles`. At most `workers` unified dataframes are pending at any time.
+    """
+    if workers < 2:
+        for cyanoFile in cyanoFiles:
+            print(f"Compiling {cyanoFile}")
+            yield unify(cyanoFile)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for cyanoFile in cyanoFiles:
+            print(f"Compiling {cyanoFile}")
+            pending.append(executor.submit(unify, cyanoFile))
+            if len(pending) >= workers: yield pending.popleft().result()
+        while len(pending) > 0: yield pending.popleft().result()
+
+
+
+def update_parts(cyanoFiles, parts, workers):
+    """
+    Keeps one unified part per colocalized file in the "PARTS_DIR", so that only the new or changed files are unified again.
+    `parts` maps the name of each previously unified file to the content hash of its colocalized file, and is updated in place.
+    Returns the list of path to the parts (in the order of `cyanoFiles`) and whether any part changed.
+    """
+    makedir(PARTS_DIR)
+    names = [os.path.splitext(os.path.basename(f))[0] for f in cyanoFiles]
+    hashes = [file_hash(f) for f in cyanoFiles]
+    stale = [i for i, name in enumerate(names) if not INCREMENTAL or parts.get(name) != hashes[i] or not os.path.isfile(data_path(PARTS_DIR, name))]
+    for i, df in zip(stale, unify_all([cyanoFiles[i] for i in stale], workers)):
+        write_chunks([df], data_path(PARTS_DIR, names[i]), compiled_schema())
+        parts[names[i]] = hashes[i]
+    removed = [name for name in parts if name not in names]
+    for name in removed:
+        if os.path.isfile(data_path(PARTS_DIR, name)): os.remove(data_path(PARTS_DIR, name))
+        del parts[name]
+    return [data_path(PARTS_DIR, name) for name in names], len(stale) + len(removed) > 0
+
 
 
 def main():
     """
-    Iterates through the list of colocalized cyano datasets and compile them into a single csv file.
-    The compiled file is stored in the "COMPILED_DIR" as a csv file.
+    Iterates through the list of colocalized cyano datasets and compile them into a single file.
+    The compiled file is stored in the "COMPILED_DIR" (see `STORAGE_FORMAT`), and optionally exported as a csv file.
+    With `INCREMENTAL`, only the colocalized files that changed since the last run are unified again.
+    With `EXPORT_TRAINING`, the compiled dataset is also exported as training arrays in the "TRAINING_DIR" (see training.py).
     """
     print(
         """
@@ -111,17 +172,20 @@ def main():
             
         """
     )
-    cyanoFiles = glob.glob(f"{COLOCALIZED_DIR}*.csv")
+    cyanoFiles = data_files(COLOCALIZED_DIR)
+    check_schemas(cyanoFiles)
     makedir(COMPILED_DIR)
-    dfCompiled  = pd.DataFrame({})
-    for cyanoFile in cyanoFiles:
-        print(f"Compiling {cyanoFile}")
-        data = unify(cyanoFile)
-        if len(dfCompiled ) < 1:
-            dfCompiled = data
-        else:
-            dfCompiled = pd.concat([dfCompiled, data], ignore_index=True)    
-    dfCompiled.to_csv(f"{COMPILED_DIR}compiled.csv", index=False)        
+    compiledFile = data_path(COMPILED_DIR, "compiled")
+    manifest = load_manifest()
+    parts = manifest["compile"].setdefault("parts", {})
+    partFiles, changed = update_parts(cyanoFiles, parts, COMPILE_WORKERS or os.cpu_count())
+    save_manifest(manifest)
+    if not changed and os.path.isfile(compiledFile):
+        print("Compiled dataset is up to date.")
+    else:
+        write_chunks((read_data(p) for p in partFiles), compiledFile, compiled_schema())
+        if EXPORT_CSV and STORAGE_FORMAT != "csv": export_csv(compiledFile, data_path(COMPILED_DIR, "compiled", "csv"), CHUNK_ROWS)
+    if EXPORT_TRAINING: export_training(compiledFile, TRAINING_DIR)
 
                     
 
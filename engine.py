@@ -0,0 +1,162 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-07
+
+Function: An asyncio engine that submits queries to the CMAP API with bounded concurrency, rate limiting, and retries.
+          The event loop, connection pool, and rate limiter persist across calls (see `engine_state`).
+"""
+
+
+
+import sys, time, atexit, asyncio, threading
+from io import StringIO
+from urllib.parse import urlencode
+import aiohttp
+import pandas as pd
+from config.config import API_KEY
+from settings import API_BASE_URL, MAX_WORKERS, RATE_LIMIT, RATE_BURST, MAX_RETRIES, QUERY_TIMEOUT
+from common import halt, backoff
+from metrics import count, add_time, observe
+
+
+
+RETRY_STATUS = {429, 500, 502, 503, 504}          # HTTP status codes that indicate a transient failure.
+_engine = {}
+_engineLock = threading.Lock()
+
+
+def token_bucket(rate, capacity):
+    """
+    Returns a coroutine function that waits until a token is available. The bucket holds at most
+    `capacity` tokens and is refilled at `rate` tokens per second.
+    """
+    tokens, last = capacity, time.monotonic()
+    lock = asyncio.Lock()
+
+    async def acquire():
+        nonlocal tokens, last
+        async with lock:
+            while True:
+                now = time.monotonic()
+                tokens = min(capacity, tokens + (now - last) * rate)
+                last = now
+                if tokens >= 1:
+                    tokens -= 1
+                    return
+                await asyncio.sleep((1 - tokens) / rate)
+
+    return acquire
+
+
+def to_dataframe(text, query):
+    """
+    Parses the csv body returned by the query endpoint. Time values are formatted the same way as `pycmap`.
+    """
+    if len(text.strip()) < 1: return pd.DataFrame({})
+    try:
+        df = pd.read_csv(StringIO(text))
+    except Exception as e:
+        print(f"Unable to parse the response to:\n{query}\n{text[:500]}\n{e}", file=sys.stderr)
+        return pd.DataFrame({})
+    if "time" in df.columns: df["time"] = pd.to_datetime(df["time"]).dt.strftime("%Y-%m-%dT%H:%M:%S")
+    return df
+
+
+async def submit(session, query, semaphore, acquire, baseURL, label):
+    """
+    Submits a single query and returns the result in form of a dataframe.
+    Transient failures are retried (outside of the concurrency slot) with jittered exponential backoff.
+    An empty dataframe is returned if the query keeps failing.
+    The latency, response size, and parsing time are recorded under the (stage, table) `label` (see metrics.py).
+    """
+    url = f"{baseURL}/api/data/query?" + urlencode({"query": query, "servername": "rainier"})
+    error = ""
+    for attempt in range(MAX_RETRIES + 1):
+        async with semaphore:
+            await acquire()
+            try:
+                tic = time.perf_counter()
+                async with session.get(url) as resp:
+                    text = await resp.text()
+                    latency = time.perf_counter() - tic
+                    observe(*label, latency, len(text))
+                    add_time(*label, "network", latency)
+                    if resp.status == 401: halt("Unauthorized API key!")
+                    if resp.status == 200: 
+                        tic = time.perf_counter()
+                        df = to_dataframe(text, query)
+                        add_time(*label, "parsing", time.perf_counter() - tic)
+                        return df
+                    error = f"HTTP {resp.status}: {text[:200]}"
+                    if resp.status not in RETRY_STATUS: break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+        if attempt < MAX_RETRIES: 
+            count(*label, "retries")
+            await asyncio.sleep(backoff(attempt))
+    count(*label, "failures")
+    print(f"Query failed after {attempt + 1} attempt(s) ({error}):\n{query}", file=sys.stderr)
+    return pd.DataFrame({})
+
+
+async def open_engine():
+    """
+    Creates the objects shared by all queries, within the running event loop: the HTTP session (a pool of 
+    persistent connections), the concurrency slots, and the token bucket.
+    """
+    headers = {"Authorization": f"Api-Key {API_KEY}"}
+    connector = aiohttp.TCPConnector(limit=MAX_WORKERS)
+    timeout = aiohttp.ClientTimeout(total=QUERY_TIMEOUT)
+    return {
+            "session": aiohttp.ClientSession(headers=headers, connector=connector, timeout=timeout),
+            "semaphore": asyncio.Semaphore(MAX_WORKERS),
+            "acquire": token_bucket(RATE_LIMIT, RATE_BURST)
+            }
+
+
+def engine_state():
+    """
+    Returns the state of the engine, created on first use: an event loop and the objects bound to it (see `open_engine`).
+    The state is kept for the lifetime of the process, so that the rate limit holds across `run_queries` calls and 
+    the connections are reused, however the queries are split into calls. It is closed at exit (see `close_engine`).
+    """
+    if "loop" not in _engine:
+        loop = asyncio.new_event_loop()
+        _engine.update(loop.run_until_complete(open_engine()))
+        _engine["loop"] = loop
+        atexit.register(close_engine)
+    return _engine
+
+
+def close_engine():
+    """
+    Closes the HTTP session and the event loop of the engine, if any.
+    """
+    with _engineLock:
+        if "loop" not in _engine: return
+        loop = _engine["loop"]
+        loop.run_until_complete(_engine["session"].close())
+        loop.close()
+        _engine.clear()
+    return
+
+
+async def submit_all(queries, baseURL, labels, state):
+    """
+    Submits the queries concurrently over the pool of persistent connections of the engine `state`.
+    """
+    session, semaphore, acquire = state["session"], state["semaphore"], state["acquire"]
+    return await asyncio.gather(*[submit(session, q, semaphore, acquire, baseURL, label) for q, label in zip(queries, labels)])
+
+
+def run_queries(queries, baseURL=API_BASE_URL, labels=None):
+    """
+    Executes a list of SQL queries against the CMAP API and returns the resulting dataframes in the same order.
+    `labels` holds the (stage, table) pair under which the metrics of each query are recorded.
+    Calls from several threads are run one after the other, on the event loop of the engine (see `engine_state`).
+    """
+    if labels is None: labels = [("engine", None)] * len(queries)
+    with _engineLock:
+        state = engine_state()
+        return state["loop"].run_until_complete(submit_all(queries, baseURL, labels, state))
@@ -0,0 +1,136 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-24
+
+Function: A regular-grid bin index over local environmental records, answering the tolerance-box averages
+          of many observations at once without comparing every observation with every record.
+"""
+
+
+
+from settings import MAX_MASK_SIZE
+import numpy as np
+
+
+
+def expand(counts):
+    """
+    For consecutive groups of the given sizes, returns the group index and the position within the group of each element.
+    """
+    group = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return group, np.arange(len(group)) - starts[group]
+
+
+def bin_sizes(boxes):
+    """
+    Returns the bin size along each coordinate of the boxes: the median box width, so that a box spans at most
+    a couple of bins per coordinate. Degenerate boxes (e.g. a single month) get unit bins.
+    """
+    sizes = {}
+    for col, (low, high) in boxes.items():
+        width = np.median(np.asarray(high, dtype=float) - np.asarray(low, dtype=float)) if len(low) > 0 else 0
+        sizes[col] = width if width > 0 else 1.0
+    return sizes
+
+
+def bin_of(index, col, x):
+    """
+    Returns the (unclipped) bin number of the positions `x` along an indexed coordinate.
+    """
+    return np.floor((np.asarray(x, dtype=float) - index["origins"][col]) / index["sizes"][col])
+
+
+def build_index(coords, values, sizes):
+    """
+    Builds the bin index of a set of records. `coords` maps each coordinate to the array of record positions
+    (float, or int64 for times), `values` is the (records x variables) array to be averaged, and `sizes` maps
+    each coordinate to its bin size. Records are sorted by bin, and each non-empty bin points to a slice of them.
+    Records with a missing coordinate are left out, as they never satisfy `BETWEEN`.
+    """
+    cols = list(coords)
+    keep = np.ones(len(values), dtype=bool)
+    for col in cols:
+        x = coords[col]
+        keep &= np.isfinite(x) if x.dtype.kind == "f" else x != np.iinfo(x.dtype).min
+    coords, values = {col: coords[col][keep] for col in cols}, values[keep]
+    index = {
+             "cols": cols,
+             "origins": {col: float(np.min(coords[col])) if len(coords[col]) > 0 else 0.0 for col in cols},
+             "sizes": sizes,
+             "shape": {}
+             }
+    keys = np.zeros(len(values), dtype=np.int64)
+    for col in cols: 
+        bins = bin_of(index, col, coords[col]).astype(np.int64)
+        index["shape"][col] = int(bins.max()) + 1 if len(bins) > 0 else 1
+        keys = keys * index["shape"][col] + bins
+    order = np.argsort(keys, kind="stable")
+    binKeys, starts = np.unique(keys[order], return_index=True)
+    index["coords"] = {col: coords[col][order] for col in cols}
+    index["values"] = values[order]
+    index["binKeys"] = binKeys
+    index["binStarts"] = np.append(starts, len(order))
+    return index
+
+
+def query_index(index, boxes):
+    """
+    Returns the (boxes x variables) averages of the indexed values within each box. `boxes` maps each indexed
+    coordinate to a pair of arrays holding the inclusive lower and upper bounds of the boxes.
+    Null values are ignored and empty boxes yield NaN, in line with the SQL `AVG ... BETWEEN` semantics.
+    """
+    boxCount = len(next(iter(boxes.values()))[0])
+    values = index["values"]
+    averages = np.full((boxCount, values.shape[1]), np.nan)
+    if len(values) < 1 or boxCount < 1: return averages
+    # enumerate the (box, bin) pairs, clipping the bin ranges to the indexed extent
+    boxIds, keys = np.arange(boxCount), np.zeros(boxCount, dtype=np.int64)
+    for col in index["cols"]:
+        low, high = boxes[col]
+        shape = index["shape"][col]
+        first = np.nan_to_num(np.clip(bin_of(index, col, low), 0, shape), nan=shape).astype(np.int64)
+        last = np.nan_to_num(np.clip(bin_of(index, col, high), -1, shape - 1), nan=-1).astype(np.int64)
+        counts = np.maximum(last[boxIds] - first[boxIds] + 1, 0)
+        group, offset = expand(counts)
+        boxIds, keys = boxIds[group], keys[group] * shape + first[boxIds[group]] + offset
+    pos = np.searchsorted(index["binKeys"], keys)
+    hit = pos < len(index["binKeys"])
+    hit[hit] = index["binKeys"][pos[hit]] == keys[hit]
+    boxIds, pos = boxIds[hit], pos[hit]
+    starts, ends = index["binStarts"][pos], index["binStarts"][pos + 1]
+    # test the records of the candidate bins exactly, a bounded number of (box, record) pairs at a time
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0)
+    sums, counts = np.zeros(averages.shape), np.zeros(averages.shape)
+    pairCounts = ends - starts
+    cumulative = np.cumsum(pairCounts)
+    chunkStart = 0
+    while chunkStart < len(boxIds):
+        before = cumulative[chunkStart] - pairCounts[chunkStart]
+        chunkEnd = max(chunkStart + 1, int(np.searchsorted(cumulative, before + MAX_MASK_SIZE, side="right")))
+        group, offset = expand(ends[chunkStart:chunkEnd] - starts[chunkStart:chunkEnd])
+        pairBoxes = boxIds[chunkStart:chunkEnd][group]
+        records = starts[chunkStart:chunkEnd][group] + offset
+        inside = np.ones(len(records), dtype=bool)
+        for col in index["cols"]:
+            low, high = boxes[col]
+            x = index["coords"][col][records]
+            inside &= (x >= np.asarray(low)[pairBoxes]) & (x <= np.asarray(high)[pairBoxes])
+        pairBoxes, records = pairBoxes[inside], records[inside]
+        for j in range(values.shape[1]):
+            sums[:, j] += np.bincount(pairBoxes, weights=filled[records, j], minlength=boxCount)
+            counts[:, j] += np.bincount(pairBoxes, weights=valid[records, j], minlength=boxCount)
+        chunkStart = chunkEnd
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = np.where(counts > 0, sums / counts, np.nan)
+    return averages
+
+
+def grid_average(coords, values, boxes):
+    """
+    Averages the `values` of the records located at `coords` within each of the `boxes` (see `query_index`),
+    through a bin index sized after the boxes.
+    """
+    return query_index(build_index(coords, values, bin_sizes(boxes)), boxes)
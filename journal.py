@@ -0,0 +1,124 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-09
+
+Function: An append-only checkpoint journal (SQLite) of the completed (row, table) matches of a cyano file,
+          allowing an interrupted colocalization to resume where it stopped.
+"""
+
+
+
+import os, json, time, datetime, sqlite3, threading
+from settings import JOURNAL_DIR, PROGRESS_INTERVAL
+from common import makedir
+import pandas as pd
+
+
+
+def journal_path(cyanoFile):
+    """
+    Returns the path to the journal of a cyano file.
+    """
+    return f"{JOURNAL_DIR}{os.path.splitext(os.path.basename(cyanoFile))[0]}.sqlite"
+
+
+def remove_journal(path):
+    """
+    Deletes a journal database (and its write-ahead log files) from disk.
+    """
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.isfile(path + suffix): os.remove(path + suffix)
+    return
+
+
+def open_journal(cyanoFile, rowCount, tableCount, reset=False):
+    """
+    Opens (or creates) the journal of a cyano file with `rowCount` observations to be matched with `tableCount`
+    environmental tables. Any previous journal is discarded if `reset` is True.
+    The journal is a dict holding the database connection and the progress counters.
+    """
+    path = journal_path(cyanoFile)
+    makedir(JOURNAL_DIR)
+    if reset: remove_journal(path)
+    con = sqlite3.connect(path, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("CREATE TABLE IF NOT EXISTS matches (row INTEGER, tbl TEXT, matched TEXT, PRIMARY KEY (row, tbl))")
+    con.commit()
+    return {
+            "path": path,
+            "con": con,
+            "lock": threading.Lock(),
+            "cyanoFile": cyanoFile,
+            "rowCount": rowCount,
+            "tableCount": tableCount,
+            "resumedPairs": con.execute("SELECT COUNT(*) FROM matches").fetchone()[0],
+            "sessionPairs": 0,
+            "startTime": time.time(),
+            "lastReport": time.time(),
+            "done": {}
+            }
+
+
+def completed(journal, table, variables):
+    """
+    Returns a dict mapping the row index of each observation already matched with `table` to the list of matched values
+    (ordered as `variables`). Entries recorded with a different set of variables are not considered complete.
+    """
+    with journal["lock"]:
+        if table not in journal["done"]:
+            rows = journal["con"].execute("SELECT row, matched FROM matches WHERE tbl=?", (table,)).fetchall()
+            journal["done"][table] = {row: json.loads(matched) for row, matched in rows}
+    done = {}
+    for row, matched in journal["done"][table].items():
+        if all(v in matched for v in variables): done[row] = [matched[v] for v in variables]
+    return done
+
+
+def record(journal, rows, table, variables, values):
+    """
+    Appends the matched `values` (one sequence per row, ordered as `variables`) of the given rows and table to the journal.
+    """
+    def to_dict(vals):
+        return {v: (None if x is None or pd.isna(x) else float(x)) for v, x in zip(variables, vals)}
+
+    matches = {int(row): to_dict(vals) for row, vals in zip(rows, values)}
+    entries = [(row, table, json.dumps(matched)) for row, matched in matches.items()]
+    with journal["lock"]:
+        journal["con"].executemany("INSERT OR REPLACE INTO matches (row, tbl, matched) VALUES (?, ?, ?)", entries)
+        journal["con"].commit()
+        if table in journal["done"]: journal["done"][table].update(matches)
+        journal["sessionPairs"] += len(entries)
+        due = time.time() - journal["lastReport"] >= PROGRESS_INTERVAL
+    if due: report(journal)
+    return
+
+
+def report(journal):
+    """
+    Prints a progress summary of the colocalization: rows done, rows remaining, and the estimated time to completion.
+    """
+    with journal["lock"]:
+        journal["lastReport"] = time.time()
+        con = journal["con"]
+        pairs = con.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        rowsDone = con.execute("SELECT COUNT(*) FROM (SELECT row FROM matches GROUP BY row HAVING COUNT(*) >= ?)", (journal["tableCount"],)).fetchone()[0]
+    remainingPairs = max(0, journal["rowCount"] * journal["tableCount"] - pairs)
+    elapsed = time.time() - journal["startTime"]
+    eta = "unknown"
+    if journal["sessionPairs"] > 0: eta = str(datetime.timedelta(seconds=round(remainingPairs * elapsed / journal["sessionPairs"])))
+    print(
+          f"{datetime.datetime.now()}: {journal['cyanoFile']}: {rowsDone} / {journal['rowCount']} rows done, "
+          f"{journal['rowCount'] - rowsDone} remaining ({journal['resumedPairs']} matches resumed), estimated time left: {eta}"
+          )
+    return
+
+
+def close_journal(journal, remove=False):
+    """
+    Closes the journal, and removes it from disk if `remove` is True (the colocalized file is saved).
+    """
+    journal["con"].close()
+    if remove: remove_journal(journal["path"])
+    return
@@ -0,0 +1,63 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-21
+
+Function: Keeps track of what each stage of the pipeline has already processed (content hashes of the files,
+          configuration of the environmental datasets, and temporal coverage of the tables), so that a re-run
+          only redoes the affected files or (file, table) pairs.
+"""
+
+
+
+import os, json, hashlib
+from settings import MANIFEST_PATH
+from common import makedir
+
+
+
+def load_manifest():
+    """
+    Loads the manifest from disk. The manifest is a dict with one entry per stage ("collect", "colocalize", "compile").
+    """
+    manifest = {"collect": {}, "colocalize": {}, "compile": {}}
+    if os.path.isfile(MANIFEST_PATH):
+        with open(MANIFEST_PATH) as f: manifest.update(json.load(f))
+    return manifest
+
+
+def save_manifest(manifest):
+    """
+    Writes the manifest to disk atomically (so that an interrupted run never leaves a corrupted manifest).
+    """
+    makedir(os.path.dirname(MANIFEST_PATH))
+    tmpPath = MANIFEST_PATH + ".tmp"
+    with open(tmpPath, "w") as f: json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmpPath, MANIFEST_PATH)
+    return
+
+
+def file_hash(path):
+    """
+    Returns the sha256 hash of a file's content.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""): h.update(block)
+    return h.hexdigest()
+
+
+def fingerprint(obj):
+    """
+    Returns a hash of a json-serializable object (non-serializable values, such as timestamps, are converted to strings).
+    """
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def env_fingerprints(envs):
+    """
+    Returns a dict mapping each environmental table to a fingerprint of its configuration
+    (variables, tolerances, flags) and temporal coverage. Any change invalidates the table's matches.
+    """
+    keys = ["variables", "tolerances", "hasDepth", "isClimatology", "startTime", "endTime"]
+    return {table: fingerprint({k: env.get(k) for k in keys}) for table, env in envs.items()}
@@ -0,0 +1,90 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-10-07
+
+Function: Local cache of the metadata of the CMAP tables (column list, temporal coverage, spatial extent, and row count),
+          so that the pipeline stages do not scan every table at startup. Entries older than `METADATA_TTL`
+          are refreshed concurrently; fresh entries are used without any query.
+"""
+
+
+
+import os, json, time, threading
+import concurrent.futures
+from settings import METADATA_PATH, METADATA_TTL, MAX_WORKERS, OFFLINE
+from common import halt, makedir
+from metrics import count, timed_query
+import pandas as pd
+
+
+
+_lock = threading.Lock()
+VERSION = 2    # version of the entry layout; entries of an older layout are refreshed.
+
+
+def load_metadata():
+    """
+    Loads the metadata cache from disk: a dict with one entry per table.
+    """
+    if not os.path.isfile(METADATA_PATH): return {}
+    with open(METADATA_PATH) as f: return json.load(f)
+
+
+def save_metadata(metadata):
+    """
+    Writes the metadata cache to disk atomically (several processes may share it).
+    """
+    makedir(os.path.dirname(METADATA_PATH))
+    tmpPath = f"{METADATA_PATH}.{os.getpid()}.tmp"
+    with open(tmpPath, "w") as f: json.dump(metadata, f, indent=2, sort_keys=True)
+    os.replace(tmpPath, METADATA_PATH)
+    return
+
+
+def is_fresh(entry, ttl=METADATA_TTL):
+    """
+    Returns True if a metadata entry of the current layout (`VERSION`) has been fetched less than `ttl` seconds ago.
+    """
+    return entry is not None and entry.get("version") == VERSION and time.time() - entry["fetched"] < ttl
+
+
+def fetch_metadata(api, table):
+    """
+    Retrieves the metadata of a table: its columns, and the time and lat/lon extents and count of its records (in a single scan).
+    Times are kept as returned by the API. Returns None if the table cannot be reached.
+    """
+    columns = list(api.columns(table))
+    if len(columns) < 1: return None
+    timeClause = "MIN([time]) startTime, MAX([time]) endTime, " if "time" in columns else ""
+    query = f"SELECT {timeClause}MIN(lat) latMin, MAX(lat) latMax, MIN(lon) lonMin, MAX(lon) lonMax, COUNT(*) rowCount FROM {table}"
+    extent = timed_query("metadata", table, api.query, query)
+    entry = {"version": VERSION, "fetched": time.time(), "columns": columns, "startTime": None, "endTime": None, "rowCount": None}
+    if len(extent) > 0:
+        for col, value in extent.iloc[0].items():
+            if pd.isna(value): entry[col] = None
+            elif col in ["startTime", "endTime"]: entry[col] = str(value)
+            else: entry[col] = int(value) if col == "rowCount" else float(value)
+    return entry
+
+
+def table_metadata(api, tables, ttl=METADATA_TTL):
+    """
+    Returns a dict of the metadata entries of the given tables (see `fetch_metadata`), read from the cache.
+    Missing and stale entries are refreshed concurrently. In `OFFLINE` mode, stale entries are used as they are and 
+    a missing entry terminates the program. Tables that cannot be reached get a None entry.
+    """
+    with _lock:
+        metadata = load_metadata()
+        stale = [table for table in tables if not is_fresh(metadata.get(table), ttl)]
+        if OFFLINE:
+            missing = [table for table in tables if table not in metadata]
+            if len(missing) > 0: halt(f"Missing table metadata in offline mode:\n{missing}")
+            stale = []
+        for table in tables: count("metadata", table, "cacheMisses" if table in stale else "cacheHits")
+        if len(stale) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                entries = list(executor.map(lambda table: fetch_metadata(api, table), stale))
+            metadata.update({table: entry for table, entry in zip(stale, entries) if entry is not None})
+            save_metadata(metadata)
+    return {table: metadata.get(table) for table in tables}
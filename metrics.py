@@ -0,0 +1,174 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-28
+
+Function: Collects per-stage and per-table metrics of the pipeline (query counts, latency histograms, bytes received,
+          cache hits, rows, and time spent in each phase), reports throttled progress, and hosts the profiling hook.
+"""
+
+
+
+import sys, json, copy, time, datetime, threading, contextlib, cProfile, pstats
+from settings import METRICS_DIR, LATENCY_BUCKETS, PROGRESS_INTERVAL
+from common import makedir
+
+
+
+_lock = threading.Lock()
+_metrics = {}
+_progress = {}
+
+
+def entry(stage, table):
+    """
+    Returns the metrics entry of a (stage, table) pair, creating it if needed. Must be called holding the lock.
+    """
+    key = (stage, table)
+    if key not in _metrics:
+        _metrics[key] = {
+                         "counts": {},
+                         "seconds": {},
+                         "latency": {"buckets": LATENCY_BUCKETS, "counts": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0, "max": 0.0}
+                         }
+    return _metrics[key]
+
+
+def count(stage, table, name, n=1):
+    """
+    Increments the counter `name` (e.g. "rows", "cacheHits") of a (stage, table) pair by `n`.
+    """
+    with _lock:
+        counts = entry(stage, table)["counts"]
+        counts[name] = counts.get(name, 0) + n
+    return
+
+
+def add_time(stage, table, phase, seconds):
+    """
+    Adds `seconds` to the time spent by a (stage, table) pair in `phase` (e.g. "network", "parsing", "assembly").
+    """
+    with _lock:
+        spent = entry(stage, table)["seconds"]
+        spent[phase] = spent.get(phase, 0.0) + seconds
+    return
+
+
+@contextlib.contextmanager
+def timed(stage, table, phase):
+    """
+    Context manager adding the time spent in its body to `phase` (see `add_time`).
+    """
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, table, phase, time.perf_counter() - tic)
+
+
+def observe(stage, table, seconds, size, sizeName="bytes"):
+    """
+    Records a query of a (stage, table) pair: its latency [s] (in the histogram bounded by `LATENCY_BUCKETS`)
+    and the `size` of its response, added to the `sizeName` counter: "bytes" for the bytes received (engine.py),
+    "frameBytes" for the in-memory size of the returned dataframe (when only the dataframe is seen, e.g. `pycmap`).
+    """
+    with _lock:
+        e = entry(stage, table)
+        latency = e["latency"]
+        bucket = sum(seconds > b for b in LATENCY_BUCKETS)
+        latency["counts"][bucket] += 1
+        latency["sum"] += seconds
+        latency["max"] = max(latency["max"], seconds)
+        e["counts"]["queries"] = e["counts"].get("queries", 0) + 1
+        e["counts"][sizeName] = e["counts"].get(sizeName, 0) + int(size)
+    return
+
+
+def timed_query(stage, table, func, query):
+    """
+    Executes `func(query)` (e.g. `pycmap.API.query`) and records its latency and the in-memory size of the returned dataframe
+    ("frameBytes", as the size of the response itself is not exposed).
+    The time is accounted to the "query" phase (network and parsing combined).
+    """
+    tic = time.perf_counter()
+    df = func(query)
+    seconds = time.perf_counter() - tic
+    observe(stage, table, seconds, df.memory_usage(deep=True).sum(), "frameBytes")
+    add_time(stage, table, "query", seconds)
+    return df
+
+
+def progress(label, done, total):
+    """
+    Prints the progress of a task (`done` out of `total` units) at most once every `PROGRESS_INTERVAL` seconds per label,
+    and always on completion.
+    """
+    now = time.time()
+    with _lock:
+        start, last = _progress.setdefault(label, (now, 0.0))
+        due = now - last >= PROGRESS_INTERVAL or done >= total
+        if due: _progress[label] = (start, now)
+    if not due: return
+    rate = done / max(now - start, 1e-9)
+    print(f"{datetime.datetime.now()}: {label}: {done} / {total} ({rate:.1f} per second)")
+    sys.stdout.flush()
+    return
+
+
+def summary():
+    """
+    Returns the collected metrics as a json-serializable list, with the derived mean latency and rows per second
+    (rows over the time spent in all phases).
+    """
+    with _lock:
+        items = copy.deepcopy(list(_metrics.items()))
+    result = []
+    for (stage, table), e in sorted(items, key=lambda item: (str(item[0][0]), str(item[0][1]))):
+        queries, seconds = e["counts"].get("queries", 0), sum(e["seconds"].values())
+        e["latency"]["mean"] = e["latency"]["sum"] / queries if queries > 0 else None
+        e["rowsPerSecond"] = e["counts"].get("rows", 0) / seconds if seconds > 0 else None
+        result.append({"stage": stage, "table": table, **e})
+    return result
+
+
+def save_metrics(name):
+    """
+    Writes the collected metrics to a timestamped json file in the "METRICS_DIR" and returns its path.
+    """
+    makedir(METRICS_DIR)
+    path = f"{METRICS_DIR}{name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(path, "w") as f: json.dump(summary(), f, indent=2)
+    print(f"Metrics saved at {path}")
+    return path
+
+
+def reset_metrics():
+    """
+    Discards the collected metrics and progress states.
+    """
+    with _lock:
+        _metrics.clear()
+        _progress.clear()
+    return
+
+
+@contextlib.contextmanager
+def profiled(name, enabled=True):
+    """
+    Context manager running its body under `cProfile` (if `enabled`). The profile is dumped to the "METRICS_DIR"
+    (readable with `pstats` or snakeviz) and the most expensive calls are printed.
+    """
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        makedir(METRICS_DIR)
+        path = f"{METRICS_DIR}{name}.prof"
+        profiler.dump_stats(path)
+        print(f"Profile saved at {path}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
@@ -0,0 +1,215 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-10-05
+
+Function: Registry of the cyano and environmental datasets: immutable dataset specs built once on first use,
+          along with the derived column orders, unit scale factors, and column rename maps.
+          Only depends on settings.py, so that listing and validating the datasets does not load pandas or pycmap:
+          python registry.py [--validate]
+"""
+
+
+
+import sys, argparse, functools, collections
+from types import MappingProxyType
+from settings import PROC, SYNC, PICO
+
+
+
+CyanoDataset = collections.namedtuple("CyanoDataset", ["table", "fields", "renames", "scale"])
+CyanoDataset.__doc__ = """
+A cyano dataset: the table name, the fields to be retrieved, the map from the abundance fields to their standard
+labels (PROC, SYNC, PICO), and the factor converting the abundances to cell/mL.
+"""
+
+ZUBKOV = {"prochlorococcus_abundance_P701A90Z_Zubkov": PROC, "synechococcus_abundance_P700A90Z_Zubkov": SYNC, "picoeukaryotic_abundance_PYEUA00A_Zubkov": PICO}
+TARRAN = {"prochlorococcus_abundance_P701A90Z_Tarran": PROC, "synechococcus_abundance_P700A90Z_Tarran": SYNC, "picoeukaryotic_abundance_PYEUA00A_Tarran": PICO}
+STANDARD_COLUMNS = ("time", "lat", "lon", "depth", "table", "cruise", PROC, SYNC, PICO)
+
+
+
+def cyano_dataset(table, fields, scale=1):
+    """
+    Returns the spec of a cyano dataset. `fields` maps each field to be retrieved to its standard label (or to itself).
+    """
+    return CyanoDataset(table, tuple(fields), MappingProxyType({f: label for f, label in fields.items() if f != label}), scale)
+
+
+@functools.lru_cache(maxsize=None)
+def cyano_datasets():
+    """
+    Compiles a tuple of Cyanobacteria datasets (see `CyanoDataset`).
+    The Seaflow dataset reports the abundance values in units of cell/uL while all other datasets are in cell/mL,
+    hence its 1000 scale factor.
+    """
+    zubkov = lambda species: {f: label for f, label in ZUBKOV.items() if label in species}
+    return (
+            cyano_dataset("tblSeaFlow", {"cruise": "cruise", "abundance_prochloro": PROC, "abundance_synecho": SYNC, "abundance_picoeuk": PICO}, scale=1000),
+            cyano_dataset("tblFlombaum", {"prochlorococcus_abundance_flombaum": PROC, "synechococcus_abundance_flombaum": SYNC}),
+            cyano_dataset("tblGlobal_PicoPhytoPlankton", {PROC: PROC, SYNC: SYNC, PICO: PICO}),
+            cyano_dataset("tblJR19980514_AMT06_Flow_Cytometry", ZUBKOV),
+            cyano_dataset("tblJR20030512_AMT12_Flow_Cytometry", ZUBKOV),
+            cyano_dataset("tblJR20030910_AMT13_Flow_Cytometry", ZUBKOV),
+            cyano_dataset("tblJR20040428_AMT14_Flow_Cytometry", ZUBKOV),
+            cyano_dataset("tblD284_AMT15_Flow_Cytometry", zubkov([PROC, SYNC])),
+            cyano_dataset("tblD294_AMT16_Flow_Cytometry", TARRAN),
+            cyano_dataset("tblD299_AMT17_Flow_Cytometry", ZUBKOV),
+            cyano_dataset("tblJR20081003_AMT18_flow_cytometry", TARRAN),
+            cyano_dataset("tblJC039_AMT19_flow_cytometry", TARRAN),
+            cyano_dataset("tblJC053_AMT20_flow_cytometry", TARRAN),
+            cyano_dataset("tblD371_AMT21_flow_cytometry", TARRAN),
+            cyano_dataset("tblJC079_AMT22_flow_cytometry", TARRAN),
+            cyano_dataset("tblJR20131005_AMT23_flow_cytometry", TARRAN),
+            cyano_dataset("tblJR20140922_AMT24_flow_cytometry", TARRAN),
+            cyano_dataset("tblJR15001_AMT25_flow_cytometry", TARRAN),
+            cyano_dataset("tblDY110_AMT29_flow_cytometry", TARRAN)
+            )
+
+
+@functools.lru_cache(maxsize=None)
+def cyano_index():
+    """
+    Returns a read-only map from the table names to the cyano dataset specs.
+    """
+    return MappingProxyType({d.table: d for d in cyano_datasets()})
+
+
+@functools.lru_cache(maxsize=None)
+def environmental_specs():
+    """
+    Returns a read-only map of the environmental datasets to be colocalized with cyanobacteria measurements.
+    Each item key represents the table name of the environmental dataset, and the item's value again is a map
+    containing the variables names, tolerance parameters, and two flags indicating if the dataset has 'depth' column,
+    and if the dataset represents a climatology product, repectively. The tolerance parametrs specify the temporal [days],
+    latitude [deg], longitude [deg], and depth [m] tolerances, respectively.
+    """
+    envs = {
+           "tblSST_AVHRR_OI_NRT": {
+                                   "variables": ("sst",),
+                                   "tolerances": (1, 0.25, 0.25, 5),
+                                   "hasDepth": False,
+                                   "isClimatology": False
+                                   },
+           "tblCHL_REP": {
+                          "variables": ("chl",),
+                          "tolerances": (4, 0.25, 0.25, 5),
+                          "hasDepth": False,
+                          "isClimatology": False
+                          },
+           "tblSSS_NRT": {
+                          "variables": ("sss",),
+                          "tolerances": (1, 0.25, 0.25, 5),
+                          "hasDepth": False,
+                          "isClimatology": False
+                          },
+           "tblModis_PAR": {
+                            "variables": ("PAR",),
+                            "tolerances": (1, 0.25, 0.25, 5),
+                            "hasDepth": False,
+                            "isClimatology": False
+                            },
+           "tblAltimetry_REP": {
+                                "variables": ("sla", "adt", "ugosa", "vgosa"),
+                                "tolerances": (1, 0.25, 0.25, 5),
+                                "hasDepth": False,
+                                "isClimatology": False
+                                },
+           "tblPisces_NRT": {
+                             "variables": ("NO3", "PO4", "Fe", "O2", "Si", "PP"),
+                             "tolerances": (4, 0.5, 0.5, 5),
+                             "hasDepth": True,
+                             "isClimatology": False
+                             },
+           "tblWOA_Climatology": {
+                                  "variables": ("density_WOA_clim", "salinity_WOA_clim", "nitrate_WOA_clim", "phosphate_WOA_clim", "silicate_WOA_clim", "oxygen_WOA_clim"),
+                                  "tolerances": (1, 0.75, 0.75, 5),
+                                  "hasDepth": True,
+                                  "isClimatology": True
+                                  }
+           }
+    return MappingProxyType({table: MappingProxyType(env) for table, env in envs.items()})
+
+
+def environmental_datasets():
+    """
+    Returns a mutable copy of the environmental datasets (see `environmental_specs`), with list values,
+    which the colocalization extends with the temporal coverage of each table.
+    """
+    return {table: {k: list(v) if isinstance(v, tuple) else v for k, v in env.items()} for table, env in environmental_specs().items()}
+
+
+@functools.lru_cache(maxsize=None)
+def env_vars():
+    """
+    Reurns a tuple of environmental variables to be colocalized with cyano observations.
+    """
+    return tuple(v for env in environmental_specs().values() for v in env["variables"])
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_columns():
+    """
+    Returns the ordered tuple of columns of the compiled dataset.
+    """
+    # columns:
+    # time | lat | lon | depth | table | cruise | <PROC> | <SYNC> | <PICO> | env_var1 | ... | env_var_n
+    return STANDARD_COLUMNS + env_vars()
+
+
+def scale_factor(table):
+    """
+    Returns the constant factor converting the cyano abundances of a table to cell/mL (1 for unregistered tables).
+    """
+    spec = cyano_index().get(table)
+    return spec.scale if spec is not None else 1
+
+
+def rename_map(table):
+    """
+    Returns the map from the abundance columns of a table to their standard labels (empty for unregistered tables).
+    """
+    spec = cyano_index().get(table)
+    return spec.renames if spec is not None else MappingProxyType({})
+
+
+def validate():
+    """
+    Checks the consistency of the registry and returns the list of problems found.
+    """
+    errors = []
+    tables = [d.table for d in cyano_datasets()] + list(environmental_specs())
+    errors += [f"duplicate table: {t}" for t, n in collections.Counter(tables).items() if n > 1]
+    for d in cyano_datasets():
+        errors += [f"{d.table}: unknown standard label {label}" for label in d.renames.values() if label not in (PROC, SYNC, PICO)]
+        errors += [f"{d.table}: duplicate standard label {label}" for label, n in collections.Counter(d.renames.values()).items() if n > 1]
+        if d.scale <= 0: errors.append(f"{d.table}: invalid scale factor {d.scale}")
+    errors += [f"duplicate environmental variable: {v}" for v, n in collections.Counter(env_vars()).items() if n > 1]
+    errors += [f"{t}: expected 4 tolerances" for t, env in environmental_specs().items() if len(env["tolerances"]) != 4]
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lists and validates the registered datasets.")
+    parser.add_argument("--validate", action="store_true", help="only check the consistency of the registry.")
+    args = parser.parse_args()
+    if not args.validate:
+        for d in cyano_datasets(): print(f"{d.table}: {', '.join(d.fields)} (x{d.scale})")
+        for table, env in environmental_specs().items(): print(f"{table}: {', '.join(env['variables'])}")
+    errors = validate()
+    for e in errors: print(e, file=sys.stderr)
+    sys.exit(1 if len(errors) > 0 else 0)
+
+
+
+
+#######################################
+#                                     #
+#                                     #
+#                 main                #
+#                                     #
+#                                     #
+#######################################
+
+if __name__ == "__main__":
+    main()
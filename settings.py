@@ -14,12 +14,32 @@ Function: Holds cross-project settings and constants.
 DATA_DIR = "./data/"                                    # where data files (observations of cyanobacteria) are stored.
 COLOCALIZED_DIR = f"{DATA_DIR}colocalized/"             # where the colocalized data files (with evironmental variables) are stored.
 COMPILED_DIR = f"{DATA_DIR}compiled/"                   # where the compiled colocalized data files are stored.
+CACHE_DIR = f"{DATA_DIR}cache/"                         # where the retrieved environmental data are cached.
+JOURNAL_DIR = f"{COLOCALIZED_DIR}journal/"              # where the checkpoint journals of the ongoing colocalizations are stored.
+PARTS_DIR = f"{COMPILED_DIR}parts/"                     # where the unified colocalized files are stored before being compiled.
+TRAINING_DIR = f"{COMPILED_DIR}training/"               # where the training arrays exported from the compiled dataset are stored.
+SHARDS_DIR = f"{COLOCALIZED_DIR}shards/"                # where the partial outputs of the colocalization shards are stored before being merged.
+MANIFEST_PATH = f"{DATA_DIR}manifest.json"              # where the record of the processed files and configurations is stored.
+METRICS_DIR = f"{DATA_DIR}metrics/"                     # where the pipeline metrics and profiles are stored.
+METADATA_PATH = f"{CACHE_DIR}metadata.json"             # where the cached metadata of the CMAP tables (columns, temporal coverage, and spatial extent) is stored.
+INCREMENTAL = True                                      # If True, each stage only redoes the files (or file-table pairs) affected by a change since the last run.
+
+
+
+#################### storage settings ####################
+STORAGE_FORMAT = "parquet"                              # File format of the raw, colocalized, and compiled datasets: "csv", "parquet", or "feather".
+ROW_GROUP_SIZE = 100_000                                # Number of rows per parquet row group (min/max statistics are stored for each row group).
+VALUE_DTYPE = "float32"                                 # dtype of the abundance and environmental columns: "float32" halves their memory footprint, "float64" keeps full precision.
+EXPORT_CSV = True                                       # If True, the compiled dataset is also exported as a csv file.
+COMPILE_WORKERS = None                                  # Number of processes unifying the colocalized files concurrently (None: number of processors, 1: sequential).
+EXPORT_TRAINING = True                                  # If True, the compiled dataset is also exported as memory-mappable training arrays (see training.py).
 
 
 
 #################### data retieval settings #################### 
 DEPTH1 = 0          # The lower bound of vertical filter to retrieve the Cyanobacteria observations.
 DEPTH2 = 5          # The upper bound of vertical filter to retrieve the Cyanobacteria observations.
+COLLECT_CHUNK_ROWS = 500_000                            # Approximate number of rows per download chunk; larger tables are retrieved in consecutive time ranges.
 
 
 
@@ -29,3 +49,48 @@ SYNC = "synechococcus_abundance"                        # A consistent label for
 PICO = "picoeukaryote_abundance"                        # A consistent label for all "picoeukaryote abundance" related observations.                    
 
 
+
+#################### training export settings ####################
+LOG_TRANSFORM = [PROC, SYNC, PICO, "chl"]               # Columns (targets or environmental variables) exported as log(1 + x).
+SPLIT_BY = "cruise"                                     # Column grouping the rows into the train and validation sets: "cruise" (the table when unknown) or "table".
+VALIDATION_FRACTION = 0.2                               # Approximate fraction of the groups assigned to the validation set.
+
+
+
+
+
+#################### colocalization settings ####################
+BATCH_COLOCALIZE = True                                 # If True, observations are colocalized in space-time tiles (one query per environmental table per tile) rather than one query per row.
+TILE_SIZE = [10, 5, 5, 10]                              # The temporal [days], latitude [deg], longitude [deg], and depth [m] extents of the tiles used to batch the observations (and to cache the environmental data).
+MAX_MASK_SIZE = 10_000_000                              # Upper bound on the number of (observation, environmental record) pairs evaluated at once when averaging within a tile.
+SET_BASED_COLOCALIZE = False                            # If True, blocks of observations are sent to the server as a list of constant rows and matched there in one query per block (falls back to BATCH_COLOCALIZE tiles if the server does not support it).
+BLOCK_ROWS = 200                                        # Maximum number of observations per set-based query.
+MAX_QUERY_LENGTH = 6000                                 # Maximum length [characters] of a url-encoded set-based query (queries are sent in the url); blocks are shrunk to fit.
+SHARD_ROWS = 50_000                                     # Number of rows of a cyano file in a sharded work unit (a row range matched with one environmental table).
+AVERAGE_BACKEND = "grid"                                # How the tolerance-box averages are computed within a tile: "grid" (bin index, see gridindex.py) or "mask" (compares every observation with every record).
+PROGRESS_INTERVAL = 10                                  # Minimum interval [s] between two colocalization progress summaries.
+CHUNK_ROWS = 10_000                                     # Number of rows assembled in memory before being written to disk (colocalization and compilation).
+
+
+
+#################### environmental data cache settings ####################
+CACHE_MAX_BYTES = 20 * 1024**3                          # Size cap of the environmental data cache [bytes]; the least recently used files are evicted beyond this limit.
+OFFLINE = False                                         # If True, environmental data and table metadata are only read from the cache (batch mode is forced) and a cache miss terminates the program.
+METADATA_TTL = 7 * 24 * 3600                            # Age [s] beyond which the cached metadata of a table is refreshed (stale metadata is used as is when OFFLINE).
+
+
+
+#################### query engine settings ####################
+API_BASE_URL = "https://simonscmap.com"                 # Root endpoint of the CMAP API (may point to a local stand-in server for testing).
+ASYNC_COLOCALIZE = False                                # If True (and BATCH_COLOCALIZE is False), the deduplicated per-row queries are submitted by the asyncio engine (engine.py) instead of a thread pool.
+MAX_WORKERS = 8                                         # Maximum number of concurrent queries (threads or open connections).
+RATE_LIMIT = 10                                         # Maximum sustained number of queries per second.
+RATE_BURST = 10                                         # Maximum number of queries that can be submitted at once after an idle period.
+MAX_RETRIES = 5                                         # Number of retries of a failed query (connection errors, timeouts, HTTP 429 and 5xx).
+BACKOFF_BASE = 0.5                                      # Base delay [s] of the jittered exponential backoff between retries.
+QUERY_TIMEOUT = 600                                     # Timeout of a single query [s].
+
+
+
+#################### instrumentation settings ####################
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]   # Upper bounds [s] of the query latency histogram buckets (plus an overflow bucket).
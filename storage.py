@@ -0,0 +1,186 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-09-14
+
+Function: Reads and writes the raw, colocalized, and compiled datasets in the storage format selected in settings.py (csv, parquet, or feather),
+          with a compact and consistent set of column types.
+"""
+
+
+
+import os, glob, operator
+from settings import STORAGE_FORMAT, ROW_GROUP_SIZE, VALUE_DTYPE
+from common import halt
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
+
+
+
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+COORDINATES = ["lat", "lon", "depth"]                     # kept in double precision, as the tolerance windows are compared against them.
+CATEGORIES = ["table", "cruise"]                          # low-cardinality string columns.
+OPERATORS = {"==": operator.eq, "=": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+
+def file_format(path):
+    """
+    Returns the storage format of a file, inferred from its extension.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    for fmt, extension in EXTENSIONS.items():
+        if ext == extension: return fmt
+    halt(f"Unsupported file format:\n{path}")
+
+
+def column_dtype(col):
+    """
+    Returns the pandas dtype of a column: datetime64 for time, float64 for the coordinates, categorical for the
+    table and cruise names, and `VALUE_DTYPE` for all other (abundance and environmental) columns.
+    """
+    if col == "time": return "datetime64[ns]"
+    if col in COORDINATES: return "float64"
+    if col in CATEGORIES: return "category"
+    return VALUE_DTYPE
+
+
+def compact(df):
+    """
+    Casts the columns of a dataframe to their compact dtypes (see `column_dtype`), in place, and returns the dataframe.
+    Missing values (None) become NaN, or NaT for times.
+    """
+    for col in df.columns:
+        dtype = column_dtype(col)
+        if str(df[col].dtype) == dtype: continue
+        if col == "time": 
+            df[col] = pd.to_datetime(df[col], utc=True).dt.tz_localize(None).astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def arrow_schema(columns):
+    """
+    Returns the arrow schema matching the compact dtypes of the given columns (categorical columns are dictionary encoded).
+    """
+    types = {"datetime64[ns]": pa.timestamp("ns"), "float64": pa.float64(), "float32": pa.float32(), "category": pa.dictionary(pa.int32(), pa.string())}
+    return pa.schema([(col, types[column_dtype(col)]) for col in columns])
+
+
+def decoded(schema):
+    """
+    Returns the schema with its dictionary-encoded fields replaced by their value type.
+    """
+    return pa.schema([pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f for f in schema])
+
+
+def data_path(directory, name, fmt=STORAGE_FORMAT):
+    """
+    Returns the path to the dataset `name` stored in `directory`.
+    """
+    return f"{directory}{name}{EXTENSIONS[fmt]}"
+
+
+def data_files(directory, fmt=STORAGE_FORMAT):
+    """
+    Returns a sorted list of path to the datasets stored in `directory`.
+    """
+    return sorted(glob.glob(f"{directory}*{EXTENSIONS[fmt]}"))
+
+
+def read_columns(path):
+    """
+    Returns the list of column names of a dataset without reading its content.
+    """
+    fmt = file_format(path)
+    if fmt == "parquet": return pq.read_schema(path).names
+    if fmt == "feather": return pa.ipc.open_file(path).schema.names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def read_data(path, columns=None, filters=None):
+    """
+    Reads a dataset into a dataframe. Only the `columns` are read (all if None).
+    `filters` is a list of (column, operator, value) tuples, e.g. [("lat", ">=", 0)], combined with AND.
+    For parquet files, the filters are pushed down to the reader so that row groups are skipped based on their statistics.
+    The columns are returned with their compact dtypes (see `compact`), whatever the format.
+    """
+    fmt = file_format(path)
+    if fmt == "parquet": return compact(pd.read_parquet(path, columns=columns, filters=filters))
+    if fmt == "feather":
+        df = feather.read_feather(path, columns=columns)
+    else:
+        df = pd.read_csv(path, usecols=columns)
+    df = compact(df)
+    for col, op, value in filters or []:
+        df = df[OPERATORS[op](df[col], value)]
+    return df.reset_index(drop=True)
+
+
+def write_data(df, path):
+    """
+    Writes a dataframe to `path` in the format indicated by the file extension.
+    """
+    fmt = file_format(path)
+    if fmt == "parquet":
+        df.to_parquet(path, index=False, row_group_size=ROW_GROUP_SIZE)
+    elif fmt == "feather":
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path, index=False)
+    return
+
+
+def write_chunks(frames, path, schema=None):
+    """
+    Streams an iterable of dataframes (with identical columns) into a single file, holding one frame in memory at a time.
+    For parquet and feather files, the arrow `schema` (inferred from the first frame if None) is enforced on all frames.
+    Feather files only hold a single dictionary per column, so their categorical columns are stored as plain strings.
+    If there is no frame, the file holds no row but still has the columns of the `schema` (if any).
+    Returns the number of rows written.
+    """
+    fmt = file_format(path)
+    rowCount, frameCount, writer = 0, 0, None
+    open(path, "w").close()
+    try:
+        for i, df in enumerate(frames):
+            rowCount += len(df)
+            frameCount += 1
+            if fmt == "csv":
+                df.to_csv(path, mode="a", header=(i == 0), index=False)
+                continue
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            if fmt == "feather": table = table.cast(decoded(table.schema))
+            if writer is None:
+                schema = table.schema
+                if fmt == "parquet": writer = pq.ParquetWriter(path, schema)
+                else: writer = pa.ipc.new_file(path, schema)
+            if fmt == "parquet": writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+            else: writer.write_table(table)
+    finally:
+        if writer is not None: writer.close()
+    if frameCount == 0: write_data(schema.empty_table().to_pandas() if schema is not None else pd.DataFrame({}), path)
+    return rowCount
+
+
+def iter_chunks(path, chunkRows):
+    """
+    Yields the content of a dataset in dataframes of about `chunkRows` rows.
+    """
+    fmt = file_format(path)
+    if fmt == "csv":
+        yield from pd.read_csv(path, chunksize=chunkRows)
+    elif fmt == "parquet":
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunkRows): yield batch.to_pandas()
+    else:
+        reader = pa.ipc.open_file(path)
+        for i in range(reader.num_record_batches): yield reader.get_batch(i).to_pandas()
+
+
+def export_csv(path, csvPath, chunkRows):
+    """
+    Exports a dataset to a csv file, chunk by chunk.
+    """
+    return write_chunks(iter_chunks(path, chunkRows), csvPath)
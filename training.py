@@ -0,0 +1,152 @@
+"""
+Author: Mohammad Dehghani Ashkezari <mdehghan@uw.edu>
+
+Date: 2020-10-09
+
+Function: Exports the compiled dataset as training-ready NumPy arrays (features, targets, missing-value masks,
+          and deterministic train/validation splits), which are memory-mapped when loaded, so that a model
+          can stream batches from disk without parsing the csv file or holding the whole dataset in memory.
+"""
+
+
+
+import os, json, zlib
+from settings import PROC, SYNC, PICO, CHUNK_ROWS, LOG_TRANSFORM, SPLIT_BY, VALIDATION_FRACTION
+from common import halt, makedir
+from registry import env_vars
+from storage import read_data, iter_chunks
+from manifest import file_hash, fingerprint
+import numpy as np
+import pandas as pd
+
+
+
+TARGETS = [PROC, SYNC, PICO]
+ARRAYS = ["features", "targets", "featureMask", "targetMask", "train", "validation"]
+
+
+def training_config():
+    """
+    Returns the settings the training arrays depend on.
+    """
+    return {
+            "features": list(env_vars()),
+            "targets": TARGETS,
+            "logTransform": LOG_TRANSFORM,
+            "maskBeforeTransform": True,
+            "splitBy": SPLIT_BY,
+            "validationFraction": VALIDATION_FRACTION
+            }
+
+
+def array_path(directory, name):
+    """
+    Returns the path to one of the training arrays (see `ARRAYS`).
+    """
+    return os.path.join(directory, f"{name}.npy")
+
+
+def transform(df, columns):
+    """
+    Returns the (rows x columns) float32 array of the given columns, log-transformed (log(1 + x)) for the
+    columns listed in `LOG_TRANSFORM`. Values below -1 become NaN.
+    """
+    values = df[columns].to_numpy(dtype=np.float32, na_value=np.nan, copy=True)
+    for j, col in enumerate(columns):
+        if col not in LOG_TRANSFORM: continue
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values[:, j] = np.log1p(np.where(values[:, j] >= -1, values[:, j], np.nan))
+    return values
+
+
+def split_groups(df):
+    """
+    Returns the group of each row used to split the dataset: its `SPLIT_BY` column ("cruise" or "table"),
+    falling back to the table when the cruise is unknown.
+    """
+    groups = df["table"].astype(str)
+    if SPLIT_BY == "cruise": groups = df["cruise"].astype(object).where(df["cruise"].notna(), groups).astype(str)
+    return groups
+
+
+def is_validation(groups):
+    """
+    Returns a boolean array marking the rows whose group falls in the validation set. The assignment only depends
+    on a stable hash of the group name, so that it is the same on every run and regardless of the other groups.
+    """
+    unique = pd.unique(groups)
+    picked = {g: zlib.crc32(g.encode()) % 10_000 < VALIDATION_FRACTION * 10_000 for g in unique}
+    return groups.map(picked).to_numpy(dtype=bool)
+
+
+def export_training(compiledFile, directory):
+    """
+    Writes the training arrays of the compiled dataset to `directory`, one `.npy` file per array (see `ARRAYS`):
+    the (rows x env_vars) features, the (rows x [PROC, SYNC, PICO]) targets, their validity masks (True where a
+    value is present in the compiled file, before the log transform), and the row indices of the train and validation sets. The compiled file is read in chunks
+    of `CHUNK_ROWS` rows, which are written straight to the memory-mapped arrays.
+    The arrays are not written again if neither the compiled file nor the training settings changed.
+    """
+    config = training_config()
+    source = file_hash(compiledFile)
+    metaPath = os.path.join(directory, "meta.json")
+    if os.path.isfile(metaPath) and all(os.path.isfile(array_path(directory, a)) for a in ARRAYS):
+        with open(metaPath) as f: meta = json.load(f)
+        if meta["source"] == source and meta["config"] == fingerprint(config):
+            print("Training arrays are up to date.")
+            return
+    makedir(directory)
+    if os.path.isfile(metaPath): os.remove(metaPath)
+    features, targets = config["features"], config["targets"]
+    rowCount = len(read_data(compiledFile, columns=["lat"]))
+    arrays = {
+              "features": np.lib.format.open_memmap(array_path(directory, "features"), mode="w+", dtype=np.float32, shape=(rowCount, len(features))),
+              "targets": np.lib.format.open_memmap(array_path(directory, "targets"), mode="w+", dtype=np.float32, shape=(rowCount, len(targets))),
+              "featureMask": np.lib.format.open_memmap(array_path(directory, "featureMask"), mode="w+", dtype=bool, shape=(rowCount, len(features))),
+              "targetMask": np.lib.format.open_memmap(array_path(directory, "targetMask"), mode="w+", dtype=bool, shape=(rowCount, len(targets)))
+              }
+    validation = np.zeros(rowCount, dtype=bool)
+    start = 0
+    for df in iter_chunks(compiledFile, CHUNK_ROWS):
+        end = start + len(df)
+        if end > rowCount: halt(f"{compiledFile} changed while exporting the training arrays.")
+        arrays["features"][start:end] = transform(df, features)
+        arrays["targets"][start:end] = transform(df, targets)
+        arrays["featureMask"][start:end] = df[features].notna().to_numpy()
+        arrays["targetMask"][start:end] = df[targets].notna().to_numpy()
+        validation[start:end] = is_validation(split_groups(df))
+        start = end
+    for a in arrays.values(): a.flush()
+    np.save(array_path(directory, "train"), np.flatnonzero(~validation))
+    np.save(array_path(directory, "validation"), np.flatnonzero(validation))
+    meta = {
+            "source": source,
+            "config": fingerprint(config),
+            "rows": rowCount,
+            "trainRows": int((~validation).sum()),
+            "validationRows": int(validation.sum()),
+            **config
+            }
+    with open(metaPath, "w") as f: json.dump(meta, f, indent=2)
+    print(f"Training arrays saved at {directory} ({meta['trainRows']} train, {meta['validationRows']} validation rows)")
+    return
+
+
+def load_training(directory):
+    """
+    Returns the training arrays (memory-mapped, read-only) and their metadata.
+    """
+    with open(os.path.join(directory, "meta.json")) as f: meta = json.load(f)
+    return {a: np.load(array_path(directory, a), mmap_mode="r") for a in ARRAYS}, meta
+
+
+def iter_batches(directory, split="train", batchRows=CHUNK_ROWS):
+    """
+    Yields (features, targets, featureMask, targetMask) batches of about `batchRows` rows of a split ("train" or
+    "validation"), read from the memory-mapped arrays in row order.
+    """
+    arrays, _ = load_training(directory)
+    rows = arrays[split]
+    for i in range(0, len(rows), batchRows):
+        batch = np.asarray(rows[i:i + batchRows])
+        yield tuple(arrays[a][batch] for a in ["features", "targets", "featureMask", "targetMask"])